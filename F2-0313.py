@@ -1,43 +1,1830 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
 import pandas as pd
 from datetime import datetime
-import matplotlib.pyplot as plt
-import pyodbc
-import tkinter as tk
-from tkinter import filedialog, messagebox
 import os
 import sys
 import json
-from openpyxl import Workbook
+import shutil
+import hashlib
+import sqlite3
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
 import numpy as np
+# matplotlib、tkinter、openpyxl、pyodbc 在第一次用到時才載入，縮短啟動時間
+_IMPORT_FINISHED = time.perf_counter()
+
+# 啟動時間量測時檢查是否被提前載入的模組
+LAZY_MODULES = ['matplotlib', 'tkinter', 'openpyxl', 'pyodbc']
+
+def load_pyplot():
+    """延遲載入 matplotlib.pyplot，使用非 GUI 的 Agg 後端（圖表只輸出成檔案）"""
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def load_filedialog():
+    """延遲載入 tkinter 檔案選擇視窗"""
+    import tkinter as tk
+    from tkinter import filedialog
+    return tk, filedialog
+
+
+# ev1020 欄位對照（中文別名 -> 原始欄位）
+EV1020_COLUMNS = {
+    '出貨日期': 'ev1020_03',
+    '廠別': 'ev1020_88',
+    '材數': 'ev1020_07',
+    '生產性質': 'ev1020_13',
+    '門市': 'ev1020_20',
+    '圖號': 'ev1020_11',
+    '色號': 'ev1020_12',
+    '客戶': 'ev1020_19',
+    '拆單人員': 'ev1020_06',
+    '重量': 'ev1020_09',
+    '門市代號': 'ev1020_05',
+}
+
+# ev1020 欄位的精簡型別，未列出的欄位保留為物件
+EV1020_DTYPES = {
+    '出貨日期': 'datetime64[ns]',
+    '材數': 'float32',
+    '重量': 'float32',
+    '廠別': 'category',
+    '門市代號': 'category',
+    '生產性質': 'category',
+    '拆單人員': 'category',
+    '客戶': 'category',
+    '門市': 'category',
+    '圖號': 'category',
+    '色號': 'category',
+}
+
+# 預估訂單欄位
+ESTIMATED_ORDER_COLUMNS = ['日期', '門市', '門市代號', '預估材數', '備註', '工廠']
+
+# 工廠登錄預設值：廠別代碼、名稱、每週最大材數（None 為不限）、圖表顏色、預估訂單查詢表
+# 新增工廠只需在 factories.json 加一筆，彙總、報表、圖表與分配建議都依登錄順序展開
+FACTORY_CONFIG_FILE = 'factories.json'
+DEFAULT_FACTORIES = [
+    {'code': '001', 'name': '彰化', 'capacity': None, 'color': 'b', 'table': '彰化查詢'},
+    {'code': '002', 'name': '台南', 'capacity': None, 'color': 'r', 'table': '台南查詢'},
+]
+
+# 各功能實際需要的欄位，查詢時只取這些欄位
+CHART_COLUMNS = ['出貨日期', '廠別', '材數', '門市代號']
+# 明細下鑽的維度；主資料一次載入圖表欄位與這些維度，下鑽時不必再查詢資料庫
+DRILLDOWN_COLUMNS = ['門市代號', '門市', '客戶', '圖號', '色號', '拆單人員']
+MAIN_DATA_COLUMNS = CHART_COLUMNS + [col for col in DRILLDOWN_COLUMNS if col not in CHART_COLUMNS]
+
+
+def get_week_start(now=None):
+    """取得當週週一 00:00"""
+    now = pd.Timestamp.now() if now is None else pd.Timestamp(now)
+    return now.normalize() - pd.Timedelta(days=now.dayofweek)
+
+
+def _ev1020_conditions(start_date=None, end_date=None, dates=None):
+    """組出 ev1020 共用的 WHERE 條件與參數"""
+    conditions = ["ev1020_13 LIKE '%生產%'"]
+    params = []
+    if start_date is not None:
+        conditions.append('ev1020_03 >= ?')
+        params.append(pd.Timestamp(start_date).to_pydatetime())
+    if end_date is not None:
+        conditions.append('ev1020_03 < ?')
+        params.append(pd.Timestamp(end_date).to_pydatetime())
+    if dates is not None:
+        conditions.append(f"ev1020_03 IN ({', '.join('?' * len(dates))})")
+        params.extend(pd.Timestamp(d).to_pydatetime() for d in dates)
+    return ' AND '.join(conditions), params
+
+
+def build_ev1020_query(columns=None, start_date=None, end_date=None, dates=None):
+    """組出 ev1020 參數化查詢，回傳 (SQL, 參數)；日期範圍為 [start_date, end_date)"""
+    columns = list(columns) if columns else list(EV1020_COLUMNS)
+    unknown = [col for col in columns if col not in EV1020_COLUMNS]
+    if unknown:
+        raise ValueError(f"未知的 ev1020 欄位：{', '.join(unknown)}")
+    select = ',\n                '.join(f'{EV1020_COLUMNS[col]} as {col}' for col in columns)
+    where, params = _ev1020_conditions(start_date, end_date, dates)
+    query = f"""
+            SELECT 
+                {select}
+            FROM ev1020
+            WHERE {where}
+            """
+    return query, params
+
+
+def build_ev1020_digest_query(start_date=None, end_date=None):
+    """組出 ev1020 每個出貨日、廠別的筆數與材數合計查詢，用來比對哪些日期有異動"""
+    where, params = _ev1020_conditions(start_date, end_date)
+    query = f"""
+            SELECT 
+                ev1020_03 as 出貨日期,
+                ev1020_88 as 廠別,
+                COUNT(*) as 筆數,
+                SUM(ev1020_07) as 材數
+            FROM ev1020
+            WHERE {where}
+            GROUP BY ev1020_03, ev1020_88
+            """
+    return query, params
+
+
+class DigestAccumulator:
+    """串流讀取時以 float64 累加每日每廠的筆數與材數，格式與資料庫端摘要一致"""
+
+    def __init__(self):
+        self._totals = {}
+
+    def add(self, dates, factories, amounts):
+        frame = pd.DataFrame({
+            '出貨日期': dates,
+            '廠別': pd.Series(factories, dtype=object).astype(str),
+            '材數': pd.to_numeric(pd.Series(amounts, dtype=object), errors='coerce').astype('float64'),
+        })
+        grouped = frame.groupby(['出貨日期', '廠別'])['材數'].agg(['size', 'sum'])
+        for (day, factory), count, total in zip(grouped.index, grouped['size'], grouped['sum']):
+            key = (pd.Timestamp(day).isoformat(), factory)
+            previous = self._totals.get(key, (0, 0.0))
+            self._totals[key] = (previous[0] + int(count), previous[1] + float(total))
+
+    def result(self):
+        return {key: (count, round(total, 3)) for key, (count, total) in self._totals.items()}
+
+
+class ColumnBuffer:
+    """預先配置的欄位緩衝區：每批資料直接轉成精簡型別寫入，容量不足時倍增"""
+
+    def __init__(self, dtype, capacity=0):
+        self.dtype = dtype
+        self.size = 0
+        self.categories = {}
+        storage = np.int32 if dtype == 'category' else np.dtype(dtype)
+        self.values = np.empty(max(capacity, 1024), dtype=storage)
+
+    def append(self, batch):
+        """寫入一批欄位值"""
+        n = len(batch)
+        if self.size + n > len(self.values):
+            self.values.resize(max(self.size + n, len(self.values) * 2), refcheck=False)
+        target = self.values[self.size:self.size + n]
+        if self.dtype == 'category':
+            # 每批先 factorize，只有不重複的值需要查全域類別表
+            codes, uniques = pd.factorize(np.asarray(batch, dtype=object))
+            lookup = np.fromiter((self.categories.setdefault(value, len(self.categories)) for value in uniques),
+                                 dtype=np.int32, count=len(uniques))
+            target[:] = np.append(lookup, -1)[codes]
+        elif self.dtype == 'object':
+            target[:] = np.asarray(batch, dtype=object)
+        elif self.dtype.startswith('datetime64'):
+            target[:] = pd.to_datetime(pd.Series(batch, dtype=object)).to_numpy(dtype=self.dtype)
+        else:
+            target[:] = pd.to_numeric(pd.Series(batch, dtype=object), errors='coerce').to_numpy(
+                dtype=self.values.dtype, na_value=np.nan)
+        self.size += n
+
+    def finish(self):
+        """回傳最終欄位，就地縮減為實際筆數而不另外複製"""
+        self.values.resize(self.size, refcheck=False)
+        if self.dtype == 'category':
+            return pd.Categorical.from_codes(self.values, categories=list(self.categories))
+        return self.values
+
+
+def read_compact_frame(batches, dtypes, capacity=0, digest=None):
+    """把 (欄位, 資料列) 批次逐批寫入欄位緩衝區，組成精簡型別的 DataFrame；尖峰記憶體只多一批資料列"""
+    buffers = {}
+    for columns, rows in batches:
+        if not buffers:
+            buffers = {col: ColumnBuffer(dtypes.get(col, 'object'), capacity) for col in columns}
+        if not rows:
+            continue
+        values = dict(zip(columns, zip(*rows)))
+        del rows
+        start = buffers[columns[0]].size
+        for col in columns:
+            buffers[col].append(values[col])
+        if digest is not None:
+            dates = buffers['出貨日期'].values[start:start + len(values['出貨日期'])]
+            digest.add(dates, values['廠別'], values['材數'])
+    return pd.DataFrame({col: buffer.finish() for col, buffer in buffers.items()})
+
+
+def concat_compact(frames):
+    """合併精簡型別的 DataFrame，類別欄位合併類別表後維持類別型別（略過沒有資料的 DataFrame）"""
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    result = pd.concat(frames, ignore_index=True)
+    for col in frames[0].columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            result[col] = pd.api.types.union_categoricals(
+                [frame[col].astype('category') for frame in frames], ignore_order=True)
+    return result
+
+
+def category_lookup(series, mapping, default=-1):
+    """依類別表把欄位對應成整數索引，只需對每個類別查一次"""
+    categorical = series if isinstance(series.dtype, pd.CategoricalDtype) else series.astype('category')
+    lookup = np.array([mapping.get(value, default) for value in categorical.cat.categories] + [default])
+    return lookup[categorical.cat.codes.to_numpy()]
+
+
+def changed_dates(old_digest, new_digest):
+    """比對兩份摘要，回傳有新增、修改或刪除資料的出貨日期"""
+    keys = set(old_digest) | set(new_digest)
+    return sorted({pd.Timestamp(day) for day, factory in keys
+                   if old_digest.get((day, factory)) != new_digest.get((day, factory))})
+
+
+def create_ev1020_table(conn):
+    """在本機替代資料庫（如 SQLite）建立與 Access 相同欄位的 ev1020 資料表"""
+    columns = ', '.join(
+        f"{name} {'REAL' if name in ('ev1020_07', 'ev1020_09') else 'TIMESTAMP' if name == 'ev1020_03' else 'TEXT'}"
+        for name in EV1020_COLUMNS.values()
+    )
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS ev1020 ({columns})")
+    cursor.close()
+    conn.commit()
+
+class FactoryRegistry:
+    """工廠登錄：每個工廠依登錄順序有一個索引，彙總陣列、報表欄位、圖表與分配建議都用這個索引"""
+
+    FALLBACK_COLORS = ['b', 'r', 'g', 'm', 'c', 'y', 'k']
+
+    def __init__(self, entries=None):
+        self.entries = [dict(entry) for entry in (entries or DEFAULT_FACTORIES)]
+        for idx, entry in enumerate(self.entries):
+            entry['code'] = str(entry['code'])
+            entry.setdefault('capacity', None)
+            entry['color'] = entry.get('color') or self.FALLBACK_COLORS[idx % len(self.FALLBACK_COLORS)]
+        self.codes = [entry['code'] for entry in self.entries]
+        self.names = [entry['name'] for entry in self.entries]
+        self.labels = [name + '廠' for name in self.names]  # 報表欄位與預估訂單「工廠」欄使用的名稱
+        self.colors = [entry['color'] for entry in self.entries]
+        # (預估訂單查詢表, 工廠名稱)；沒有查詢表的工廠不讀取預估訂單
+        self.tables = [(entry['table'], label) for entry, label in zip(self.entries, self.labels) if entry.get('table')]
+        self._code_index = {code: idx for idx, code in enumerate(self.codes)}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def load(cls, path=FACTORY_CONFIG_FILE):
+        """從設定檔載入工廠登錄，檔案不存在或格式錯誤時使用預設的兩廠"""
+        try:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f).get('factories')
+                if entries:
+                    return cls(entries)
+        except Exception as e:
+            print(f"讀取工廠設定時出錯，使用預設工廠：{str(e)}")
+        return cls()
+
+    def save(self, path=FACTORY_CONFIG_FILE):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'factories': self.entries}, f, ensure_ascii=False, indent=2)
+
+    def index(self, key):
+        """以廠別代碼、名稱（彰化）或工廠名稱（彰化廠）找索引"""
+        key = str(key)
+        for keys in (self.codes, self.names, self.labels):
+            if key in keys:
+                return keys.index(key)
+        raise ValueError(f"找不到工廠：{key}")
+
+    def lookup(self, codes):
+        """ev1020 廠別欄位轉成工廠索引（未登錄的廠別為 -1）"""
+        return category_lookup(codes, self._code_index)
+
+    def capacities(self):
+        """各廠每週最大材數陣列，未設定（None 或 0）為無限大"""
+        return np.array([entry['capacity'] or np.inf for entry in self.entries], dtype='float64')
+
+    def uncapped_labels(self):
+        """未設定每週最大材數的工廠名稱"""
+        return [label for entry, label in zip(self.entries, self.labels) if not entry['capacity']]
+
+    def set_capacity(self, key, value):
+        self.entries[self.index(key)]['capacity'] = value or None
+
+
+def normalize_estimated_orders(df, factories=None):
+    """預估訂單欄位轉型：日期為 datetime、預估材數為數值、門市代號與工廠為類別（類別順序同工廠登錄）"""
+    df = df.reindex(columns=ESTIMATED_ORDER_COLUMNS).reset_index(drop=True)
+    df['日期'] = pd.to_datetime(df['日期'], errors='coerce')
+    df['預估材數'] = pd.to_numeric(df['預估材數'], errors='coerce').astype('float64')
+    df['門市代號'] = df['門市代號'].fillna('').astype(str).astype('category')
+    df['工廠'] = pd.Categorical(df['工廠'], categories=(factories or FactoryRegistry()).labels)
+    return df
+
+
+class DataSource:
+    """資料來源介面：connect 取得連線、query 回傳 DataFrame、close 關閉連線；閒置連線放回連線池重複使用"""
+
+    def __init__(self, path, pool_size=4):
+        self.path = path
+        self.pool_size = pool_size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        raise NotImplementedError
+
+    def quote_identifier(self, name):
+        """資料表名稱加上引號（Access 與 SQLite 都接受方括號）"""
+        return f'[{name}]'
+
+    def connect(self):
+        """取得一條連線，優先使用連線池中的閒置連線"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def release(self, conn):
+        """歸還連線；連線池已滿時直接關閉"""
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """借用一條連線，發生錯誤時關閉而不放回連線池"""
+        conn = self.connect()
+        try:
+            yield conn
+        except BaseException:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            raise
+        else:
+            self.release(conn)
+
+    def query(self, sql, params=None):
+        """執行查詢並回傳 DataFrame"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params or [])
+                columns = [column[0] for column in cursor.description]
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    def iter_batches(self, sql, params=None, batch_size=50000):
+        """以 fetchmany 分批取回資料，逐批回傳 (欄位名稱, 資料列)；沒有資料時也會回傳一次欄位名稱"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params or [])
+                columns = [column[0] for column in cursor.description]
+                rows = cursor.fetchmany(batch_size)
+                yield columns, rows
+                while rows:
+                    rows = cursor.fetchmany(batch_size)
+                    if rows:
+                        yield columns, rows
+            finally:
+                cursor.close()
+
+    def read_table(self, table):
+        """讀取整個資料表"""
+        return self.query(f"SELECT * FROM {self.quote_identifier(table)}")
+
+    def close(self):
+        """關閉連線池中所有連線"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class AccessDataSource(DataSource):
+    """Microsoft Access（MDB/ACCDB）透過 ODBC 連線"""
+
+    def _open(self):
+        conn_str = (
+            r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};'
+            f'DBQ={self.path};'
+        )
+        import pyodbc
+        return pyodbc.connect(conn_str)
+
+
+class SQLiteDataSource(DataSource):
+    """本機 SQLite 資料庫（Access 鏡像或測試用替代資料庫），欄位與 Access 相同"""
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"找不到資料庫檔案：{self.path}")
+        sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+
+class DuckDBDataSource(DataSource):
+    """本機 DuckDB 資料庫，需另外安裝 duckdb 套件"""
+
+    def quote_identifier(self, name):
+        return '"' + name.replace('"', '""') + '"'
+
+    def _open(self):
+        import duckdb
+        return duckdb.connect(self.path)
+
+
+# 依副檔名選擇資料來源
+DATA_SOURCE_TYPES = {
+    '.mdb': AccessDataSource,
+    '.accdb': AccessDataSource,
+    '.db': SQLiteDataSource,
+    '.sqlite': SQLiteDataSource,
+    '.sqlite3': SQLiteDataSource,
+    '.duckdb': DuckDBDataSource,
+}
+
+
+def create_data_source(path):
+    """依檔案副檔名建立資料來源，未知副檔名視為 Access"""
+    extension = os.path.splitext(path)[1].lower()
+    return DATA_SOURCE_TYPES.get(extension, AccessDataSource)(path)
+
+
+def mirror_to_sqlite(source, target_path, tables):
+    """把來源資料表完整複製到本機 SQLite，供之後以 SQLiteDataSource 快速讀取"""
+    tmp_path = f'{target_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+    conn = sqlite3.connect(tmp_path)
+    try:
+        for table in tables:
+            df = source.read_table(table)
+            for col in df.columns:
+                if pd.api.types.is_datetime64_any_dtype(df[col]):
+                    df[col] = df[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+            columns = ', '.join(f'"{col}"' for col in df.columns)
+            conn.execute(f'CREATE TABLE "{table}" ({columns})')
+            placeholders = ', '.join('?' * len(df.columns))
+            conn.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})',
+                             df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, target_path)
+
+
+def source_signature(path):
+    """取得來源檔案的大小與修改時間，用來判斷快照是否失效"""
+    st = os.stat(path)
+    return {'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+class SourceWatcher:
+    """在背景執行緒輪詢來源檔案的大小與修改時間；檔案變動後要再等 debounce 秒沒有新的變動，才呼叫一次 callback，
+    拆單軟體連續寫入時只更新一次。callback 收到有變動的路徑集合，在監看執行緒中執行"""
+
+    def __init__(self, paths, callback, interval=2.0, debounce=5.0):
+        self.paths = list(dict.fromkeys(paths))
+        self.callback = callback
+        self.interval = interval
+        self.debounce = debounce
+        self.updates = 0
+        self._signatures = {path: self._signature(path) for path in self.paths}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _signature(path):
+        try:
+            return source_signature(path)
+        except OSError:
+            return None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='SourceWatcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """停止監看；正在執行的更新會先完成"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        pending = set()
+        last_change = 0.0
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            for path in self.paths:
+                signature = self._signature(path)
+                if signature != self._signatures[path]:
+                    self._signatures[path] = signature
+                    pending.add(path)
+                    last_change = now
+            if pending and now - last_change >= self.debounce:
+                changed, pending = pending, set()
+                self.updates += 1
+                try:
+                    self.callback(changed)
+                except Exception as e:
+                    print(f"自動更新時發生錯誤：{str(e)}")
+
+
+def peak_memory_mb():
+    """目前行程到此為止的尖峰記憶體（MB）：Windows 用 PeakWorkingSetSize，其他系統用 ru_maxrss"""
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            from ctypes import wintypes
+
+            class ProcessMemoryCounters(ctypes.Structure):
+                _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+                    (name, ctypes.c_size_t) for name in (
+                        'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                        'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+            counters = ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                     ctypes.byref(counters), counters.cb)
+            return counters.PeakWorkingSetSize / 1024 / 1024
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    except Exception:
+        return float('nan')
+
+
+class StageTracer:
+    """各階段計時：記錄耗時、輸入/輸出筆數與行程尖峰記憶體，寫成 JSON lines 追蹤檔並在結束時印出彙總表
+    未啟用時 traced 包裝的函式只多一次屬性檢查與一次背景作業進度回報（不在背景作業中時只查一次執行緒區域變數）"""
+
+    DEFAULT_PATH = 'f2_trace.jsonl'
+
+    def __init__(self):
+        self.path = None
+        self.records = []
+        self._file = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def enable(self, path=None):
+        """開始記錄（追加寫入 path），程式結束時印出彙總表"""
+        if self.enabled:
+            return
+        import atexit
+        self.path = path or self.DEFAULT_PATH
+        self._file = open(self.path, 'a', encoding='utf-8')
+        atexit.register(self.finish)
+
+    def enable_from_environment(self):
+        """環境變數 F2_TRACE 設為檔案路徑（或 1）時啟用"""
+        value = os.environ.get('F2_TRACE', '').strip()
+        if value and value.lower() not in ('0', 'false', 'no'):
+            self.enable(None if value.lower() in ('1', 'true', 'yes') else value)
+
+    @staticmethod
+    def _count(counter, *args, **kwargs):
+        """計算筆數；追蹤只是輔助，計算失敗時記為 None，不影響實際的階段"""
+        try:
+            return counter(*args, **kwargs)
+        except Exception:
+            return None
+
+    def run(self, stage, func, args, kwargs, rows_in=None, rows_out=None):
+        """執行 func 並記錄一筆階段資料；回傳 False 或拋出例外都視為失敗"""
+        stack = self._local.__dict__.setdefault('stack', [])
+        record = {'stage': stage, 'parent': stack[-1] if stack else None,
+                  'thread': threading.current_thread().name, 'ok': True}
+        if rows_in:
+            record['rows_in'] = self._count(rows_in, *args, **kwargs)
+        peak_before = peak_memory_mb()
+        stack.append(stage)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+            record['ok'] = result is not False
+            if rows_out and record['ok']:
+                record['rows_out'] = self._count(rows_out, result)
+            return result
+        except BaseException as e:
+            record['ok'] = False
+            record['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 6)
+            stack.pop()
+            peak = peak_memory_mb()
+            record['peak_mb'] = round(peak, 1)
+            record['peak_growth_mb'] = round(peak - peak_before, 1)
+            record['ts'] = datetime.now().isoformat(timespec='milliseconds')
+            self._write(record)
+
+    def _write(self, record):
+        with self._lock:
+            self.records.append(record)
+            if self._file:
+                self._file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                self._file.flush()
+
+    def summary(self):
+        """依階段彙總：次數、總耗時、最長耗時、輸入/輸出筆數、尖峰記憶體、失敗次數"""
+        with self._lock:
+            records = pd.DataFrame(self.records)
+        if records.empty:
+            return pd.DataFrame()
+        records = records.reindex(columns=['stage', 'seconds', 'rows_in', 'rows_out', 'peak_mb', 'ok'])
+        summary = records.groupby('stage', sort=False).agg(
+            次數=('seconds', 'size'), 總秒數=('seconds', 'sum'), 最長秒數=('seconds', 'max'),
+            輸入筆數=('rows_in', lambda rows: rows.sum(min_count=1)),
+            輸出筆數=('rows_out', lambda rows: rows.sum(min_count=1)),
+            尖峰MB=('peak_mb', 'max'), 失敗=('ok', lambda ok: int((~ok.astype(bool)).sum())))
+        summary[['輸入筆數', '輸出筆數']] = summary[['輸入筆數', '輸出筆數']].astype('Int64')
+        return summary.sort_values('總秒數', ascending=False).round(3)
+
+    def finish(self):
+        """印出彙總表並關閉追蹤檔"""
+        if not self.enabled:
+            return
+        summary = self.summary()
+        if not summary.empty:
+            print("\n=== 各階段耗時 ===")
+            print(summary.to_string())
+            print(f"追蹤檔：{self.path}")
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+        self.path = None
+
+
+TRACER = StageTracer()
+TRACER.enable_from_environment()
+
+
+def traced(stage, rows_in=None, rows_out=None):
+    """階段計時裝飾器；rows_in 以原參數計算輸入筆數，rows_out 以回傳值計算輸出筆數（計算失敗時記為 None）
+    每次呼叫也會向目前執行緒的背景作業回報階段並檢查是否已取消"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            report_progress(stage)
+            if TRACER.path is None:
+                return func(*args, **kwargs)
+            return TRACER.run(stage, func, args, kwargs, rows_in, rows_out)
+        return wrapper
+    return decorator
+
+
+def report_progress(stage=None, rows=0):
+    """目前執行緒屬於背景作業時回報進度並檢查是否已取消，否則不做任何事"""
+    job = BackgroundJob.current()
+    if job is not None:
+        job.checkpoint(stage, rows)
+
+
+def holding_data_lock(func):
+    """方法執行期間持有 self.data_lock，背景載入交付新資料時不會讀到一半"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.data_lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class JobCancelled(BaseException):
+    """背景作業被取消；繼承 BaseException，才不會被載入函式的 except Exception 當成一般錯誤（例如改為完整重新載入）"""
+
+
+class BackgroundJob:
+    """在背景執行緒執行長時間作業（載入、圖表、匯出），選單可隨時查看目前階段與已處理筆數，或要求取消
+    作業在每個 traced 階段開始、每批讀取或寫入的資料列時檢查是否已取消；
+    載入函式都是全部計算完成後才一次更新物件狀態，取消時原本的資料不受影響"""
+
+    _local = threading.local()
+
+    def __init__(self, name, func, *args, **kwargs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.stage = '等待開始'
+        self.rows = 0
+        self.result = None
+        self.error = None
+        self.started = None
+        self.elapsed = None
+        self._cancel = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def current(cls):
+        """目前執行緒所屬的背景作業，不在背景作業中時為 None"""
+        return getattr(cls._local, 'job', None)
+
+    @classmethod
+    @contextmanager
+    def binding(cls, job):
+        """讓目前執行緒（例如執行緒池中的工作）也向 job 回報進度"""
+        previous = cls.current()
+        cls._local.job = job
+        try:
+            yield
+        finally:
+            cls._local.job = previous
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name=f'BackgroundJob-{self.name}', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        with BackgroundJob.binding(self):
+            try:
+                self.result = self.func(*self.args, **self.kwargs)
+                self.stage = '已完成'
+            except JobCancelled:
+                self.stage = '已取消'
+            except Exception as e:
+                self.error = e
+                self.stage = '失敗'
+                print(f"背景作業「{self.name}」發生錯誤：{str(e)}")
+            finally:
+                self.elapsed = time.perf_counter() - self.started
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def cancel(self):
+        """要求取消，作業在下一個檢查點停止"""
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def checkpoint(self, stage=None, rows=0):
+        """回報進度（目前階段、新處理的筆數）；已要求取消時拋出 JobCancelled"""
+        if self._cancel.is_set():
+            raise JobCancelled(self.name)
+        if stage:
+            self.stage = stage
+        self.rows += rows
+
+    def track(self, batches, stage=None):
+        """逐批回報 (欄位, 資料列) 批次的筆數，取消時關閉來源的游標"""
+        try:
+            for columns, rows in batches:
+                self.checkpoint(stage, len(rows))
+                yield columns, rows
+        finally:
+            batches.close()
+
+    def describe(self):
+        seconds = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        rows = f"，已處理 {self.rows:,} 筆" if self.rows else ''
+        return f"{self.name}：{self.stage}{rows}（{seconds:.1f} 秒）"
+
+
+class SnapshotCache:
+    """本機欄式快照快取：每個欄位存成一個 .npy 檔，來源檔案大小或修改時間改變即失效"""
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()  # 多個來源同時載入時，寫入與淘汰依序進行
+
+    def _entry_dir(self, name, source_path):
+        key = hashlib.sha1(f'{source_path}|{name}'.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, key)
+
+    @traced('讀取快照', rows_out=lambda df: 0 if df is None else len(df))
+    def get(self, name, source_path, params=None):
+        """讀取快照；來源或查詢參數不符時刪除並回傳 None"""
+        entry = self._entry_dir(name, source_path)
+        meta_path = os.path.join(entry, 'meta.json')
+        try:
+            if not os.path.exists(meta_path):
+                return None
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta['source'] != source_signature(source_path) or meta['params'] != params:
+                shutil.rmtree(entry, ignore_errors=True)
+                return None
+            data = {}
+            for i, column in enumerate(meta['columns']):
+                # 不使用 mmap_mode，避免 Windows 上檔案被映射而無法淘汰
+                values = np.load(os.path.join(entry, f'c{i}.npy'))
+                if column['kind'] == 'categorical':
+                    categories = np.load(os.path.join(entry, f'c{i}.cats.npy'))
+                    values = pd.Categorical.from_codes(values, categories=categories.astype(object))
+                elif column['kind'] == 'category':
+                    categories = np.load(os.path.join(entry, f'c{i}.cats.npy')).astype(object)
+                    decoded = np.full(len(values), None, dtype=object)
+                    valid = values >= 0
+                    decoded[valid] = categories[values[valid]]
+                    values = decoded
+                data[column['name']] = values
+            os.utime(meta_path)  # 更新最後使用時間，供淘汰順序使用
+            return pd.DataFrame(data, columns=[column['name'] for column in meta['columns']])
+        except Exception as e:
+            print(f"讀取本機快照時出錯：{str(e)}")
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+
+    @traced('寫入快照', rows_in=lambda self, name, source_path, df, *args, **kwargs: len(df))
+    def put(self, name, source_path, df, params=None, signature=None):
+        """寫入快照；signature 應在讀取來源前取得，讀取期間來源有變動時下次即會失效"""
+        entry = self._entry_dir(name, source_path)
+        tmp = f'{entry}.tmp-{os.getpid()}-{threading.get_ident()}'
+        try:
+            signature = signature or source_signature(source_path)
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            columns = []
+            for i, col in enumerate(df.columns):
+                kind, values, categories = self._encode_column(df[col])
+                np.save(os.path.join(tmp, f'c{i}.npy'), values, allow_pickle=False)
+                if categories is not None:
+                    np.save(os.path.join(tmp, f'c{i}.cats.npy'), categories, allow_pickle=False)
+                columns.append({'name': str(col), 'kind': kind})
+            meta = {'name': name, 'source': signature, 'params': params,
+                    'rows': len(df), 'columns': columns}
+            with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            with self._lock:
+                shutil.rmtree(entry, ignore_errors=True)
+                os.replace(tmp, entry)
+                self.evict()
+            return True
+        except Exception as e:
+            print(f"寫入本機快照時出錯：{str(e)}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+
+    @staticmethod
+    def _encode_column(series):
+        """欄位轉成 (種類, 數值陣列, 類別陣列)；文字欄位以類別代碼儲存"""
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return 'datetime', series.to_numpy(dtype='datetime64[ns]'), None
+        if pd.api.types.is_float_dtype(series) and isinstance(series.dtype, np.dtype):
+            return 'number', series.to_numpy(), None
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories = np.asarray(series.cat.categories.astype(str), dtype=str)
+            return 'categorical', series.cat.codes.to_numpy().astype(np.int32), categories
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            return 'number', series.to_numpy(dtype='float64', na_value=np.nan), None
+        inferred = pd.api.types.infer_dtype(series, skipna=True)
+        if inferred in ('decimal', 'floating', 'integer', 'mixed-integer-float'):
+            return 'number', pd.to_numeric(series).to_numpy(dtype='float64', na_value=np.nan), None
+        if inferred in ('datetime', 'datetime64', 'date'):
+            return 'datetime', pd.to_datetime(series).to_numpy(dtype='datetime64[ns]'), None
+        categorical = pd.Categorical(series)
+        categories = np.asarray(categorical.categories.astype(str), dtype=str)
+        return 'category', categorical.codes.astype(np.int32), categories
+
+    def evict(self):
+        """總大小超過上限時，依最後使用時間由舊到新刪除快照（寫入中的暫存資料夾不計）"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if '.tmp-' in name:
+                continue
+            entry = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(entry, 'meta.json')
+            if not os.path.exists(meta_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(meta_path), size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def chart_path(self, key):
+        """圖表快取檔路徑（依內容雜湊命名，與欄式快照分開存放）"""
+        return os.path.join(self.cache_dir, 'charts', f'{key}.png')
+
+    def prune_charts(self, keep=20):
+        """只保留最近使用的 keep 張快取圖表"""
+        chart_dir = os.path.join(self.cache_dir, 'charts')
+        if not os.path.isdir(chart_dir):
+            return
+        files = sorted((os.path.getmtime(os.path.join(chart_dir, f)), os.path.join(chart_dir, f))
+                       for f in os.listdir(chart_dir) if f.endswith('.png'))
+        for _, path in files[:-keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """刪除所有快照"""
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+
+def classify_store_codes(codes):
+    """門市代號分類（向量化）：S 開頭為專案、P 開頭為代工、其餘為零售，回傳類別索引"""
+    codes = pd.Series(codes)
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        # 類別型別只需分類各類別，再依代碼展開
+        categories = classify_store_codes(pd.Series(codes.cat.categories, dtype=object))
+        return np.append(categories, 0).astype(np.int8)[codes.cat.codes.to_numpy()]
+    if not (pd.api.types.is_object_dtype(codes) or pd.api.types.is_string_dtype(codes)):
+        return np.zeros(len(codes), dtype=np.int8)
+    text = codes.astype(object)
+    is_project = text.str.startswith('S', na=False).to_numpy(dtype=bool)
+    is_oem = text.str.startswith('P', na=False).to_numpy(dtype=bool)
+    return np.select([is_project, is_oem], [1, 2], 0).astype(np.int8)
+
+
+class PeriodCalendar:
+    """以整數序號表示週（週一起始，與 to_period('W') 相同）或月；
+    彙總、排序與比對都用序號，標籤與起始日每個序號只產生一次並快取"""
+
+    INVALID = np.iinfo(np.int64).min  # 日期為空值時的序號
+
+    def __init__(self, freq):
+        self.freq = freq
+        self._labels = {}
+
+    def ordinals(self, dates):
+        """日期陣列轉成期間序號（向量化，不產生任何字串）"""
+        values = np.asarray(dates, dtype='datetime64[ns]')
+        if self.freq == 'W':
+            # 1970-01-01 為週四，平移 3 天讓每個序號從週一開始
+            ordinals = (values.astype('datetime64[D]').astype(np.int64) + 3) // 7
+        else:
+            ordinals = values.astype('datetime64[M]').astype(np.int64)
+        return np.where(np.isnat(values), self.INVALID, ordinals)
+
+    def ordinal(self, date):
+        return int(self.ordinals([pd.Timestamp(date).to_datetime64()])[0])
+
+    def start(self, ordinal):
+        """期間起始日"""
+        if self.freq == 'W':
+            return pd.Timestamp(np.datetime64(int(ordinal) * 7 - 3, 'D'))
+        return pd.Timestamp(np.datetime64(int(ordinal), 'M'))
+
+    def end(self, ordinal):
+        """期間最後一天"""
+        return self.start(ordinal + 1) - pd.Timedelta(days=1)
+
+    def label(self, ordinal):
+        """週為「YYYY/MM/DD-YYYY/MM/DD」、月為「YYYY/MM」"""
+        label = self._labels.get(ordinal)
+        if label is None:
+            if self.freq == 'W':
+                label = self.start(ordinal).strftime('%Y/%m/%d') + '-' + self.end(ordinal).strftime('%Y/%m/%d')
+            else:
+                label = self.start(ordinal).strftime('%Y/%m')
+            self._labels[ordinal] = label
+        return label
+
+
+WEEKS = PeriodCalendar('W')
+MONTHS = PeriodCalendar('M')
+
+
+class AggregationCube:
+    """預先彙總的 (期間 × 工廠 × 門市類別 × 指標) 材數陣列，報表、圖表與匯出共用；工廠維度依工廠登錄順序"""
+
+    CATEGORIES = ['零售', '專案', '代工']
+    METRICS = ['實際', '預估']
+
+    def __init__(self, calendar, ordinals, values):
+        self.calendar = calendar
+        self.ordinals = np.asarray(ordinals, dtype=np.int64)
+        self.periods = pd.DatetimeIndex([calendar.start(o) for o in self.ordinals])
+        self.labels = [calendar.label(o) for o in self.ordinals]
+        self.values = values
+
+    @classmethod
+    def build(cls, calendar, ordinals, sources, factory_count, actual=None):
+        """sources 為 (期間序號, 工廠索引, 門市類別索引, 指標索引, 材數) 的清單，一次 bincount 累加
+        ordinals 為要彙總的期間序號（遞增），factory_count 為登錄的工廠數
+        actual 為已預先彙總的實際材數 {期間序號: (工廠 × 門市類別) 陣列}，直接填入實際指標"""
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        shape = (len(ordinals), factory_count, len(cls.CATEGORIES), len(cls.METRICS))
+        flat_parts, weight_parts = [], []
+        for keys, factory, category, metric, amount in sources:
+            keys = np.asarray(keys, dtype=np.int64)
+            period = np.searchsorted(ordinals, keys)
+            found = period < len(ordinals)
+            found[found] = ordinals[period[found]] == keys[found]
+            period = np.where(found, period, -1)
+            factory = np.asarray(factory)
+            amount = np.nan_to_num(np.asarray(amount, dtype='float64'))
+            valid = (period >= 0) & (factory >= 0)
+            flat = ((period * shape[1] + factory) * shape[2] + np.asarray(category)) * shape[3] + metric
+            flat_parts.append(flat[valid])
+            weight_parts.append(amount[valid])
+        size = int(np.prod(shape))
+        if flat_parts:
+            values = np.bincount(np.concatenate(flat_parts).astype(np.int64),
+                                 weights=np.concatenate(weight_parts), minlength=size)
+        else:
+            values = np.zeros(size)
+        # 沒有任何來源資料時 bincount 回傳整數陣列，先轉成浮點數再填入實際材數
+        values = values.astype('float64').reshape(shape)
+        for period, ordinal in enumerate(ordinals.tolist()):
+            if actual and ordinal in actual:
+                values[period, :, :, 0] += actual[ordinal]
+        return cls(calendar, ordinals, values)
+
+    def factory_metric(self, metric):
+        """各期間各廠某指標的材數（門市類別加總），回傳 (期間 × 工廠)"""
+        return self.values[:, :, :, metric].sum(axis=2)
+
+    def factory_category(self):
+        """各期間各 (工廠, 門市類別) 的合計材數（實際 + 預估），回傳 (期間 × 工廠*門市類別)，工廠在外層"""
+        return self.values.sum(axis=3).reshape(len(self.ordinals), -1)
+
+
+class DrillDownIndex:
+    """ev1020 明細的下鑽索引：列依 (週, 工廠) 排序並記錄每個區塊的起訖位移，任一週、任一廠的明細直接切片；
+    各維度欄位另外依類別碼排序並記錄位移（第一次用到該維度時建立），查單一門市、客戶等也只需切片"""
+
+    BLANK = '(空白)'
+
+    def __init__(self, frame, factories, weeks=None):
+        """weeks 為要索引的週序號（例如報表的週），其他週的列視為無效，不會出現在下鑽結果"""
+        self.frame = frame
+        self.factories = factories
+        count = len(factories)
+        row_weeks = WEEKS.ordinals(frame['出貨日期'])
+        factory = factories.lookup(frame['廠別'])
+        valid = (row_weeks != PeriodCalendar.INVALID) & (factory >= 0)
+        if weeks is not None:
+            valid &= np.isin(row_weeks, np.fromiter(weeks, dtype=np.int64))
+        self.weeks, week_idx = np.unique(row_weeks[valid], return_inverse=True)
+        # 每列所屬的 (週, 工廠) 區塊編號，無效列為 -1
+        self.row_block = np.full(len(frame), -1, dtype=np.int64)
+        self.row_block[valid] = week_idx * count + factory[valid]
+        order = np.argsort(self.row_block, kind='stable')
+        first = np.searchsorted(self.row_block[order], 0)
+        self.block_rows = order[first:]
+        self.block_offsets = np.searchsorted(self.row_block[self.block_rows], np.arange(len(self.weeks) * count + 1))
+        self.amounts = np.nan_to_num(frame['材數'].to_numpy(dtype='float64'))
+        self._columns = {}
+        self._keys = {}
+
+    def column(self, column):
+        """維度欄位的類別碼（0 為空白）與類別名稱"""
+        if column not in self._columns:
+            if column not in DRILLDOWN_COLUMNS:
+                raise ValueError(f"不支援的下鑽維度：{column}")
+            values = self.frame[column]
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype('category')
+            codes = values.cat.codes.to_numpy().astype(np.int64) + 1
+            labels = [self.BLANK] + [str(value) for value in values.cat.categories]
+            self._columns[column] = (codes, labels)
+        return self._columns[column]
+
+    def key_rows(self, column, value):
+        """某維度某個值的所有明細列（依類別碼排序的列索引 + 位移）"""
+        codes, labels = self.column(column)
+        if column not in self._keys:
+            order = np.argsort(codes, kind='stable')
+            self._keys[column] = (order, np.searchsorted(codes[order], np.arange(len(labels) + 1)),
+                                  {label: idx for idx, label in enumerate(labels)})
+        order, offsets, lookup = self._keys[column]
+        code = lookup.get(str(value))
+        if code is None:
+            raise ValueError(f"{column} 沒有「{value}」的出貨資料")
+        return order[offsets[code]:offsets[code + 1]]
+
+    def week_position(self, week):
+        position = int(np.searchsorted(self.weeks, week))
+        if position >= len(self.weeks) or self.weeks[position] != week:
+            raise ValueError(f"{WEEKS.label(week)} 沒有出貨資料")
+        return position
+
+    def select(self, week=None, factory=None, where=None):
+        """篩選明細列：week 為週序號、factory 為工廠索引、where 為 (維度, 值)，都可省略"""
+        count = len(self.factories)
+        offsets = self.block_offsets
+        if week is not None:
+            # 同一週各廠的區塊相鄰，整週或單一廠都是一段連續切片
+            first = self.week_position(week) * count + (factory if factory is not None else 0)
+            last = first + 1 if factory is not None else first + count
+            rows = self.block_rows[offsets[first]:offsets[last]]
+        elif factory is not None:
+            rows = np.concatenate([self.block_rows[offsets[b]:offsets[b + 1]]
+                                   for b in range(factory, len(self.weeks) * count, count)] or [np.zeros(0, np.int64)])
+        else:
+            rows = self.block_rows
+        if where is not None:
+            matched = self.key_rows(*where)
+            if week is None and factory is None:
+                rows = matched[self.row_block[matched] >= 0]
+            else:
+                mask = np.zeros(len(self.frame), dtype=bool)
+                mask[matched] = True
+                rows = rows[mask[rows]]
+        return rows
+
+    def top(self, column, week=None, factory=None, n=10, where=None):
+        """依維度加總材數，回傳材數最多的前 n 名（材數、筆數、占比）"""
+        rows = self.select(week, factory, where)
+        codes, labels = self.column(column)
+        selected = codes[rows]
+        totals = np.bincount(selected, weights=self.amounts[rows], minlength=len(labels))
+        counts = np.bincount(selected, minlength=len(labels))
+        present = np.flatnonzero(counts)
+        ranked = present[np.argsort(-totals[present], kind='stable')][:n]
+        grand = totals.sum()
+        return pd.DataFrame({
+            column: [labels[code] for code in ranked],
+            '材數': totals[ranked],
+            '筆數': counts[ranked],
+            '占比': totals[ranked] / grand if grand else np.nan,
+        })
+
+    def breakdown(self, column, value):
+        """某維度某個值在各週、各廠的材數（每週一列）與筆數"""
+        rows = self.key_rows(column, value)
+        blocks = self.row_block[rows]
+        rows, blocks = rows[blocks >= 0], blocks[blocks >= 0]
+        count = len(self.factories)
+        size = len(self.weeks) * count
+        totals = np.bincount(blocks, weights=self.amounts[rows], minlength=size).reshape(-1, count)
+        counts = np.bincount(blocks, minlength=size).reshape(-1, count).sum(axis=1)
+        present = np.flatnonzero(counts)
+        frame = pd.DataFrame(totals[present], columns=self.factories.labels)
+        frame.insert(0, '日期區間', [WEEKS.label(int(week)) for week in self.weeks[present]])
+        frame['合計材數'] = totals[present].sum(axis=1)
+        frame['筆數'] = counts[present]
+        return frame
+
+
+def report_numeric_columns(labels):
+    """報表數值欄位：各廠實際、預估、合計材數（依工廠登錄順序），最後是比例兩側的合計材數差異"""
+    return ([f'{label}材數' for label in labels] + [f'{label}預估材數' for label in labels]
+            + [f'{label}合計材數' for label in labels] + ['合計材數差異'])
+
+
+class RatioPlan:
+    """比例比較的兩側：pair 模式為 A 廠 / B 廠，total 模式為 A 廠占全部工廠合計的比例（B 側為其餘工廠）"""
+
+    def __init__(self, factories, mode='pair', pair=None):
+        if mode not in ('pair', 'total'):
+            raise ValueError(f"比例模式必須是 pair 或 total：{mode}")
+        if len(factories) < 2:
+            raise ValueError(f"比例比較至少需要登錄兩個工廠，目前只有 {len(factories)} 個（請在 {FACTORY_CONFIG_FILE} 新增工廠）")
+        pair = list(pair or factories.codes[:2])
+        if len(pair) < (1 if mode == 'total' else 2):
+            raise ValueError(f"比例設定的工廠不足：{pair}（pair 模式需要兩個工廠代碼）")
+        self.mode = mode
+        self.share = mode == 'total'
+        self.a = factories.index(pair[0])
+        if self.share:
+            self.b = [idx for idx in range(len(factories)) if idx != self.a]
+        else:
+            self.b = [factories.index(pair[1])]
+            if self.b[0] == self.a:
+                raise ValueError("比例的兩側不可為同一個工廠")
+        self.a_label = factories.labels[self.a]
+        self.b_label = factories.labels[self.b[0]] if len(self.b) == 1 else '其他工廠'
+        self.a_name = factories.names[self.a]
+        self.b_name = factories.names[self.b[0]] if len(self.b) == 1 else '其他工廠'
+        self.key = (self.mode, self.a, tuple(self.b))
+
+    @classmethod
+    def from_settings(cls, factories, settings, check=True):
+        """依比例設定建立；check 為 True 時一併檢查上下限是否符合比例模式"""
+        plan = cls(factories, settings.get('mode', 'pair'), settings.get('pair'))
+        if check:
+            plan.check_thresholds(settings['upper'], settings['lower'])
+        return plan
+
+    def valid_threshold(self, value):
+        """比例上下限是否有效：pair 模式大於 0；total 模式是占比，必須介於 0 與 1 之間（可傳入陣列）"""
+        value = np.asarray(value, dtype='float64')
+        return (value > 0) & (value < 1) if self.share else value > 0
+
+    def threshold_range(self):
+        return "介於0與1之間（占比）" if self.share else "大於0"
+
+    def check_thresholds(self, upper, lower):
+        if not (self.valid_threshold(upper) and self.valid_threshold(lower)):
+            raise ValueError(f"{self.describe()}的上下限必須{self.threshold_range()}，"
+                             f"目前為上限 {upper}、下限 {lower}（請用選項6或 --upper/--lower 重新設定）")
+        if lower >= upper:
+            raise ValueError("下限值必須小於上限值")
+
+    def sides(self, values):
+        """(..., 工廠數) 陣列拆成 A 側與 B 側的合計"""
+        values = np.asarray(values, dtype='float64')
+        return values[..., self.a], values[..., self.b].sum(axis=-1)
+
+    def ratio(self, a, b):
+        """pair 為 A / B，total 為 A / (A + B)；分母為 0 時為 NaN"""
+        denominator = np.asarray(a + b if self.share else b, dtype='float64')
+        safe = np.where(denominator != 0, denominator, 1.0)
+        return np.where(denominator != 0, a / safe, np.nan)
+
+    def describe(self):
+        if self.share:
+            return f"{self.a_label}占全部工廠合計材數的比例"
+        return f"{self.a_label}合計材數 / {self.b_label}合計材數"
+
+
+class ReportModel:
+    """數值型比較報告（每週一列）；格式化交給主控台、Excel、圖表各自的輸出函式"""
+
+    def __init__(self, frame, data_version, settings, plan, numeric_columns):
+        self.frame = frame
+        self.data_version = data_version
+        self.settings = settings
+        self.plan = plan
+        self.numeric_columns = numeric_columns
+
+    @property
+    def empty(self):
+        return self.frame.empty
+
+    @property
+    def display_columns(self):
+        return ['日期區間'] + self.numeric_columns + ['合計材數比例', '訂單分配建議', '建議分配量']
+
+    def subset(self, mask):
+        """只含部分週的報表（例如只輸出有變動的週）"""
+        return ReportModel(self.frame[mask].reset_index(drop=True), self.data_version, self.settings,
+                           self.plan, self.numeric_columns)
+
+    def with_settings(self, settings):
+        """只依新的比例上下限重算建議欄位，其餘數值欄位沿用"""
+        upper, lower = settings
+        frame = self.frame.copy(deep=False)
+        frame['訂單分配建議'], frame['建議分配下限'], frame['建議分配上限'] = \
+            suggest_allocation(frame, upper, lower, self.plan)
+        return ReportModel(frame, self.data_version, settings, self.plan, self.numeric_columns)
+
+    def totals(self):
+        """合計列（數值），比例以合計材數計算，無法計算時為 NaN"""
+        totals = {col: float(self.frame[col].sum()) for col in self.numeric_columns}
+        ratio = self.plan.ratio(self.frame['比例工廠合計材數'].sum(), self.frame['對照工廠合計材數'].sum())
+        totals['合計材數比例'] = float(ratio)
+        return totals
+
+
+def allocation_bounds(ratio, c1, c2, upper, lower, share=False):
+    """建議分配量公式（可廣播：上下限可為 (情境數, 1) 陣列）
+    c1、c2 為比例兩側（A、B）的合計材數，share 為 True 時比例與上下限是 A 占兩側合計的比例
+    回傳 (建議給 B, 建議給 A, 建議分配下限, 建議分配上限)"""
+    to_b = ratio > upper
+    to_a = ratio < lower
+    total = c1 + c2
+    # 以 A 側目標占比 s 計算：移往 B 為 A - s*(A+B)，移往 A 為 s*(A+B) - A
+    # 兩廠比例時 s = 比例/(1+比例)，與 (A+B)/(1+2.2) - B、((A+B)/(1+1.8))*1.8 - A 相同
+    share_low = lower if share else lower / (1 + lower)
+    share_high = upper if share else upper / (1 + upper)
+    low = np.select([to_b, to_a], [c1 - share_low * total, share_low * total - c1], np.nan)
+    high = np.select([to_b, to_a], [c1 - share_high * total, share_high * total - c1], np.nan)
+    return to_b, to_a, low, high
+
+
+def suggest_allocation(frame, upper, lower, plan):
+    """依合計材數比例與上下限，向量化算出訂單分配建議與建議分配量上下限"""
+    ratio = frame['合計材數比例'].to_numpy(dtype='float64')
+    c1 = frame['比例工廠合計材數'].to_numpy(dtype='float64')
+    c2 = frame['對照工廠合計材數'].to_numpy(dtype='float64')
+    to_b, to_a, low, high = allocation_bounds(ratio, c1, c2, upper, lower, plan.share)
+    suggestion = np.select([np.isnan(ratio), to_b, to_a],
+                           ['無法計算', f'建議分配給{plan.b_label}', f'建議分配給{plan.a_label}'],
+                           '訂單分配正常').astype(object)
+    return suggestion, low, high
+
+
+# 情境參數：比例上下限與比例兩側的每週最大材數（B 側為多個工廠時是其產能合計）
+SCENARIO_COLUMNS = ['upper', 'lower', 'capacity_a', 'capacity_b']
+
+
+def scenario_labels(plan):
+    return {'upper': '比例上限', 'lower': '比例下限',
+            'capacity_a': f'{plan.a_label}產能', 'capacity_b': f'{plan.b_label}產能'}
+
+
+def parse_grid_values(text, default=None):
+    """情境參數：以逗號分隔，可用 起:迄:間距 表示區間（含迄值）；空白時使用 default"""
+    text = text.strip()
+    if not text:
+        return [default]
+    values = []
+    for part in text.split(','):
+        if ':' in part:
+            start, stop, step = (float(x) for x in part.split(':'))
+            values.extend(np.round(np.arange(start, stop + step / 2, step), 6).tolist())
+        else:
+            values.append(float(part))
+    return values
+
+
+def scenario_grid(uppers, lowers, capacities_a, capacities_b):
+    """所有參數組合（下限須小於上限），回傳情境表"""
+    grid = np.array(np.meshgrid(uppers, lowers, capacities_a, capacities_b, indexing='ij'), dtype='float64')
+    scenarios = pd.DataFrame(grid.reshape(4, -1).T, columns=SCENARIO_COLUMNS)
+    return scenarios[scenarios['lower'] < scenarios['upper']].reset_index(drop=True)
+
+
+def evaluate_scenarios(frame, scenarios, plan, detail=False):
+    """以廣播一次算出所有情境（列）× 所有週（欄）的分配建議，回傳每個情境一列的摘要
+    產能為 0 或空值表示不限；「產能不足週數」為最少移轉量也會讓接收側超過產能的週
+    detail 為 True 時另外回傳 (情境, 週) 的明細表（只含需要調整的週）"""
+    ratio = frame['合計材數比例'].to_numpy(dtype='float64')
+    c1 = frame['比例工廠合計材數'].to_numpy(dtype='float64')
+    c2 = frame['對照工廠合計材數'].to_numpy(dtype='float64')
+    params = scenarios[SCENARIO_COLUMNS].to_numpy(dtype='float64')
+    upper, lower = params[:, 0:1], params[:, 1:2]
+    capacity = np.where(np.isnan(params[:, 2:4]) | (params[:, 2:4] <= 0), np.inf, params[:, 2:4])
+    cap1, cap2 = capacity[:, 0:1], capacity[:, 1:2]
+    
+    to_b, to_a, low, high = allocation_bounds(ratio, c1, c2, upper, lower, plan.share)
+    least = np.fmin(low, high)
+    most = np.fmax(low, high)
+    short = (to_b & (c2 + least > cap2)) | (to_a & (c1 + least > cap1))
+    overloaded = (c1 > cap1) | (c2 > cap2)
+    
+    a_name, b_name = plan.a_name, plan.b_name
+    summary = scenarios[SCENARIO_COLUMNS].reset_index(drop=True).copy()
+    summary['正常週數'] = (~to_b & ~to_a & ~np.isnan(ratio)).sum(axis=1)
+    summary[f'建議給{b_name}週數'] = to_b.sum(axis=1)
+    summary[f'建議給{a_name}週數'] = to_a.sum(axis=1)
+    summary[f'移往{b_name}材數(最少)'] = np.where(to_b, least, 0).sum(axis=1)
+    summary[f'移往{b_name}材數(最多)'] = np.where(to_b, most, 0).sum(axis=1)
+    summary[f'移往{a_name}材數(最少)'] = np.where(to_a, least, 0).sum(axis=1)
+    summary[f'移往{a_name}材數(最多)'] = np.where(to_a, most, 0).sum(axis=1)
+    summary['產能不足週數'] = short.sum(axis=1)
+    summary['已超過產能週數'] = overloaded.sum(axis=1)
+    if not detail:
+        return summary
+    
+    scenario_idx, week_idx = np.nonzero(to_b | to_a)
+    weeks = pd.DataFrame({
+        '情境': scenario_idx,
+        '日期區間': frame['日期區間'].to_numpy()[week_idx],
+        '訂單分配建議': np.where(to_b[scenario_idx, week_idx], f'建議分配給{plan.b_label}', f'建議分配給{plan.a_label}'),
+        '最少移轉材數': least[scenario_idx, week_idx],
+        '最多移轉材數': most[scenario_idx, week_idx],
+        '產能不足': short[scenario_idx, week_idx],
+    })
+    return summary, weeks
+
+
+def format_suggested_amount(frame):
+    """依建議方向與建議分配上下限組出「建議分配量」文字"""
+    suggestion = frame['訂單分配建議'].astype(str)
+    low = frame['建議分配下限'].map('{:,.0f}'.format)
+    up = frame['建議分配上限'].map('{:,.0f}'.format)
+    # 「建議分配給X廠」的接收工廠直接取自建議文字，不必知道有幾個工廠
+    return np.select(
+        [suggestion.str.startswith('建議分配給').to_numpy(), (suggestion == '訂單分配正常').to_numpy()],
+        ['建議分配到' + suggestion.str[5:] + '：' + low + ' ~ ' + up + ' 材數', '維持現有分配'],
+        '-')
+
+
+def render_report_table(model):
+    """主控台用：數值欄位加千分位、比例取兩位小數的文字報表"""
+    frame = model.frame
+    df = pd.DataFrame({'日期區間': frame['日期區間']})
+    for col in model.numeric_columns:
+        df[col] = frame[col].map('{:,.0f}'.format)
+    df['合計材數比例'] = frame['合計材數比例'].map(lambda x: '{:.2f}'.format(x) if pd.notnull(x) else '-')
+    df['訂單分配建議'] = frame['訂單分配建議']
+    df['建議分配量'] = format_suggested_amount(frame)
+    return df[model.display_columns]
+
+
+def render_report_excel(model):
+    """Excel 用：數值欄位保持數值（取到小數兩位，去掉 float32 材數累加帶出的誤差），最後加上合計列"""
+    frame = model.frame
+    df = frame[['日期區間'] + model.numeric_columns].round(2)
+    df['合計材數比例'] = frame['合計材數比例'].round(2)
+    df['訂單分配建議'] = frame['訂單分配建議']
+    df['建議分配量'] = format_suggested_amount(frame)
+    total_row = {col: round(value, 2) for col, value in model.totals().items()}
+    total_row['日期區間'] = '合計'
+    total_row['訂單分配建議'] = '-'
+    total_row['建議分配量'] = '-'
+    return pd.concat([df, pd.DataFrame([total_row])], ignore_index=True)[model.display_columns]
+
+
+def changed_report_weeks(old_model, new_model):
+    """比較更新前後的報表，回傳 (新報表中數值或建議有變動、或新增的週的遮罩, 已移除的週標籤)"""
+    new = new_model.frame.set_index('日期區間')
+    columns = new_model.numeric_columns
+    if old_model is None or old_model.numeric_columns != columns:
+        return np.ones(len(new), dtype=bool), []
+    old = old_model.frame.set_index('日期區間')
+    aligned = old.reindex(new.index)
+    values_changed = ~np.isclose(new[columns].to_numpy(dtype='float64'),
+                                 aligned[columns].to_numpy(dtype='float64')).all(axis=1)
+    suggestion_changed = (new['訂單分配建議'] != aligned['訂單分配建議']).to_numpy()
+    removed = [label for label in old.index if label not in new.index]
+    return values_changed | suggestion_changed, removed
+
+
+# 圖表面板：實際與預估、合計、門市類別（週）、門市類別（月）
+CHART_PANELS = ['實際與預估', '合計', '門市類別週', '門市類別月']
+# 門市類別長條依 (工廠, 門市類別) 順序取色，工廠超過兩個時循環使用
+CHART_COLORS = ['#008000', '#0000FF', '#800080', '#FF0000', '#FFA500', '#FFFF00',
+                '#00CED1', '#8B4513', '#808080']  # 綠 藍 紫 紅 橘 黃 青 棕 灰
+CHART_RENDER_VERSION = 2  # 繪圖程式改變時加一，讓舊的快取圖表失效
+
+
+def chart_content_hash(data, **options):
+    """圖表輸入資料與繪圖選項的內容雜湊，相同時可直接沿用已繪製的圖檔"""
+    payload = json.dumps({'data': data, 'options': options, 'version': CHART_RENDER_VERSION},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:24]
+
+
+def _label_bars(ax, container, values):
+    """一次加上整組長條的數值標籤（0 不標示）"""
+    ax.bar_label(container, labels=[f'{int(v):,}' if v > 0 else '' for v in values], fontsize=8)
+
+
+def _capacity_lines(ax, data):
+    """各廠最大產能橫線（未設定的工廠不畫）"""
+    for factory in data['factories']:
+        if factory['capacity']:
+            ax.axhline(y=factory['capacity'], color=factory['color'], linestyle=':', label=f"{factory['label']}最大產能")
+
+
+def _mark_offsets(count):
+    """折線數值標籤的垂直位移：上下交錯、越後面的線離得越遠（10, -15, 25, -30, ...）"""
+    return [(10 + 15 * (k // 2) + 5 * (k % 2)) * (1 if k % 2 == 0 else -1) for k in range(count)]
+
+
+def draw_chart_panel(ax, panel, data, draft=False):
+    """在 ax 上畫一個面板；草稿模式不標示折線的每個點、圖例固定位置，以減少文字排版時間"""
+    labels = data['labels']
+    series = data['series']
+    factories = data['factories']
+    legend_loc = 'upper left' if draft else 'best'
+    if panel in ('實際與預估', '合計'):
+        if panel == '實際與預估':
+            # 第一個子圖：各廠實際材數和預估材數
+            lines = [(f"{factory['label']}材數", factory['color'], '-', 'o', f"{factory['label']}實際材數")
+                     for factory in factories]
+            lines += [(f"{factory['label']}預估材數", factory['color'], '--', '^', f"{factory['label']}預估材數")
+                      for factory in factories]
+        else:
+            # 第二個子圖：各廠合計材數比較
+            _capacity_lines(ax, data)
+            lines = [(f"{factory['label']}合計材數", factory['color'], '-', 'o', f"{factory['label']}合計材數")
+                     for factory in factories]
+        for column, color, style, marker, name in lines:
+            ax.plot(labels, series[column], color=color, linestyle=style, marker=marker, label=name)
+        if panel == '實際與預估':
+            _capacity_lines(ax, data)
+        else:
+            # 添加比例參考線（比例工廠在理想比例下的合計材數）
+            for ratio in data['ratios']:
+                ax.plot(labels, np.asarray(data['ratio_base']) * ratio, '--',
+                        alpha=0.5, label=f'理想比例 {ratio}')
+        
+        # 添加數據標籤（草稿模式省略）
+        marks = zip([line[0] for line in lines], _mark_offsets(len(lines)))
+        if not draft:
+            for column, offset in marks:
+                for x, y in zip(labels, series[column]):
+                    ax.annotate(f'{int(y):,}', (x, y), textcoords="offset points",
+                                xytext=(0, offset), ha='center', fontsize=8)
+        ax.set_title('實際材數與預估材數比較' if panel == '實際與預估' else '合計材數比較', fontsize=14, pad=20)
+        ax.set_xlabel('日期區間', fontsize=12)
+        ax.set_ylabel('材數', fontsize=12)
+        ax.legend(fontsize=10, loc=legend_loc)
+        ax.grid(True)
+        # 不要再呼叫set_xticks/set_xticklabels，直接用tick_params旋轉
+        ax.tick_params(axis='x', rotation=45, labelsize=10)
+        return
+    
+    # 門市類別長條圖：週只畫有數值的長條，月固定畫三個月
+    weekly = panel == '門市類別週'
+    period_labels = data['week_labels'] if weekly else data['month_labels']
+    bars = data['week_bars'] if weekly else data['month_bars']
+    groups = data['groups']
+    bar_width = min(0.12, 0.72 / len(groups))
+    x = np.arange(len(period_labels))
+    offset = (np.arange(len(groups)) - (len(groups) - 1) / 2) * bar_width
+    for idx, group in enumerate(groups):
+        y = np.asarray(bars[idx], dtype=float)
+        mask = y > 0 if weekly else np.ones(len(y), dtype=bool)
+        if mask.any():
+            container = ax.bar(x[mask] + offset[idx], y[mask], width=bar_width,
+                               color=CHART_COLORS[idx % len(CHART_COLORS)], label=group)
+            _label_bars(ax, container, y[mask])
+    ax.set_xticks(x)
+    ax.set_xticklabels(period_labels, rotation=45, ha='right', fontsize=10)
+    ax.set_ylabel('材數', fontsize=12)
+    ax.set_title('合計門市類別材數' if weekly else '合計門市類別材數（月）', fontsize=14, pad=20)
+    handles, names = ax.get_legend_handles_labels()
+    by_label = dict(zip(names, handles))
+    ax.legend(by_label.values(), by_label.keys(), fontsize=10, loc=legend_loc)
+    ax.grid(True, axis='y', linestyle='--', alpha=0.5)
+
+
+def render_chart(data, filename, panels=None, dpi=300, draft=False):
+    """把指定面板畫成一張圖檔（可在子行程中執行），回傳檔名"""
+    plt = load_pyplot()
+    panels = panels or CHART_PANELS
+    # 設置中文字型
+    plt.rcParams['font.sans-serif'] = ['Microsoft JhengHei']
+    plt.rcParams['axes.unicode_minus'] = False
+    fig, axes = plt.subplots(len(panels), 1, figsize=(15, 6 * len(panels)), squeeze=False)
+    try:
+        for ax, panel in zip(axes[:, 0], panels):
+            draw_chart_panel(ax, panel, data, draft)
+        # 調整整體布局；草稿模式不做 bbox_inches='tight'（需要多繪製一次）
+        fig.tight_layout()
+        fig.savefig(filename, dpi=dpi, bbox_inches=None if draft else 'tight')
+    finally:
+        plt.close(fig)
+    return filename
+
+
+# Excel 每張工作表最多 1,048,576 列（含標題列）
+EXCEL_MAX_ROWS = 1048575
+EXCEL_SHEET_INVALID = str.maketrans({c: '-' for c in '[]:*?/\\'})
+
+
+def excel_column_widths(frame):
+    """以欄為單位向量化估算欄寬（中文字算兩格），類別欄位只量測類別值"""
+    widths = []
+    for name in frame.columns:
+        series = frame[name]
+        header = len(str(name)) + sum(ord(c) > 127 for c in str(name))
+        if series.empty:
+            widths.append(header + 2)
+            continue
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            series = pd.Series(series.cat.categories.astype(str))
+        if pd.api.types.is_datetime64_any_dtype(series):
+            width = 10
+        elif pd.api.types.is_bool_dtype(series):
+            width = 5
+        elif pd.api.types.is_numeric_dtype(series):
+            values = series.to_numpy(dtype='float64')
+            largest = np.nanmax(np.abs(values)) if np.isfinite(values).any() else 0
+            # 整數位數＋負號＋小數部分（浮點數以 Excel 一般格式約 10 位有效數字估算）
+            digits = int(np.floor(np.log10(largest))) + 1 if largest >= 1 else 1
+            decimals = 0 if pd.api.types.is_integer_dtype(series) else max(0, 10 - digits) + 1
+            width = digits + decimals + int((values < 0).any())
+        else:
+            text = series.dropna().astype(str)
+            width = int((text.str.len() + text.str.count(r'[^\x00-\x7f]')).max()) if not text.empty else 0
+        widths.append(max(width, header) + 2)
+    return widths
+
+
+def write_excel_sheet(workbook, title, frame, widths=None, chunk_size=5000):
+    """以 write-only 模式分段寫入一張工作表：欄寬先設定好，資料每次只轉換 chunk_size 列"""
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+    
+    worksheet = workbook.create_sheet(title=title.translate(EXCEL_SHEET_INVALID)[:31])
+    for idx, width in enumerate(widths or excel_column_widths(frame), start=1):
+        worksheet.column_dimensions[get_column_letter(idx)].width = width
+    worksheet.freeze_panes = 'A2'
+    header = []
+    for name in frame.columns:
+        cell = WriteOnlyCell(worksheet, value=str(name))
+        cell.font = Font(bold=True)
+        header.append(cell)
+    worksheet.append(header)
+    
+    for offset in range(0, len(frame), chunk_size):
+        chunk = frame.iloc[offset:offset + chunk_size]
+        report_progress(f'寫入工作表 {title}', len(chunk))
+        columns = []
+        for name in chunk.columns:
+            series = chunk[name]
+            if pd.api.types.is_datetime64_any_dtype(series):
+                values = series.dt.date.astype(object)
+            elif series.dtype == np.float32:
+                # float32 轉回 float64 時會帶出 31.7685546875 這類誤差，取到小數三位
+                values = series.astype('float64').round(3).astype(object)
+            else:
+                values = series.astype(object)
+            columns.append(values.where(series.notna(), None).tolist())
+        for row in zip(*columns):
+            worksheet.append(row)
+    return worksheet
+
+
+def _pick_orders(amounts, need, slack):
+    """貪婪挑選要移轉的訂單，使移轉量落在 [need, slack]：
+    有單筆即可補足缺口時取其中最小的一筆，否則取不超過 slack 的最大一筆再繼續；回傳挑選的位置"""
+    picked = []
+    available = np.ones(len(amounts), dtype=bool)
+    while need > 1e-9:
+        fits = available & (amounts <= slack + 1e-9)
+        if not fits.any():
+            break
+        closing = fits & (amounts >= need - 1e-9)
+        if closing.any():
+            idx = int(np.flatnonzero(closing)[np.argmin(amounts[closing])])
+        else:
+            idx = int(np.flatnonzero(fits)[np.argmax(amounts[fits])])
+        picked.append(idx)
+        available[idx] = False
+        need -= amounts[idx]
+        slack -= amounts[idx]
+    return picked
+
+
+def _factory_target(total, upper, lower, capacity_a, capacity_b, share=False):
+    """比例工廠（A 側）合計材數的目標區間：比例區間與產能限制的交集；
+    無交集時以產能為優先（比例無法達成），兩側產能合計不足時以兩側各自產能為界（產能不足）
+    產能以兩側合計判斷，同一側有多個工廠時，各廠是否超過自己的產能由呼叫端另外檢查"""
+    share_low = lower if share else lower / (1 + lower)
+    share_high = upper if share else upper / (1 + upper)
+    ratio_low, ratio_high = total * share_low, total * share_high
+    cap_low, cap_high = total - capacity_b, capacity_a
+    status = '符合'
+    if cap_low > cap_high:
+        cap_low, cap_high = cap_high, cap_low
+        status = '產能不足'
+    low, high = max(ratio_low, cap_low), min(ratio_high, cap_high)
+    if low > high:
+        low, high = cap_low, cap_high
+        if status == '符合':
+            status = '比例無法達成'
+    return low, high, status
+
+
+def allocate_orders(actual, orders, factories, plan, upper, lower, max_advance_weeks=0):
+    """把預估訂單分配到工廠與週：各週比例兩側的合計材數盡量落在 [lower, upper] 內且各廠不超過每週最大材數，
+    只調整必要的訂單（貪婪法，每週以向量運算挑選）
+    actual：{週序號: 各廠實際材數陣列（依工廠登錄順序）}；orders：預估訂單（需含 日期、預估材數、工廠）
+    移往 B 側而 B 側有多個工廠時，每筆訂單放到當時餘裕最多的工廠；不在比例兩側的工廠不調整
+    max_advance_weeks > 0 時，產能合計不足的週可把訂單提前到前幾週有餘裕的週生產（每個工廠都要設定最大材數）
+    各週狀態與超出產能材數都以各廠自己的最大材數判斷（同一側的其他工廠有餘裕也不抵銷）
+    回傳 (每筆訂單的分配結果, 各週摘要)"""
+    count = len(factories)
+    capacity = factories.capacities()
+    capacity_a, capacity_b = plan.sides(capacity)
+    current_week = WEEKS.ordinal(get_week_start())
+    amounts = np.nan_to_num(orders['預估材數'].to_numpy(dtype='float64'))
+    original_factory = orders['工廠'].cat.codes.to_numpy().astype(np.int64) if len(orders) else np.zeros(0, np.int64)
+    original_week = WEEKS.ordinals(orders['日期']) if len(orders) else np.zeros(0, np.int64)
+    valid = (original_factory >= 0) & (original_week >= current_week)
+    factory = original_factory.copy()
+    week = original_week.copy()
+    weeks = np.unique(np.concatenate([np.fromiter(actual.keys(), dtype=np.int64, count=len(actual)),
+                                      week[valid]]))
+    fixed = np.zeros((len(weeks), count))
+    for position, w in enumerate(weeks):
+        if int(w) in actual:
+            fixed[position] = actual[int(w)]
+    
+    def load_of(position):
+        """某週各廠的合計材數（實際 + 目前分配的預估訂單）"""
+        members = valid & (week == weeks[position])
+        return fixed[position] + np.bincount(factory[members], weights=amounts[members], minlength=count)
+    
+    # 產能合計不足的週：大單優先提前到前幾週有餘裕的週（依週先後處理）
+    if max_advance_weeks > 0 and np.isfinite(capacity).all():
+        for position in range(len(weeks)):
+            overflow = load_of(position).sum() - capacity.sum()
+            if overflow <= 0:
+                continue
+            members = np.flatnonzero(valid & (week == weeks[position]))
+            for earlier in range(position - 1, -1, -1):
+                if weeks[position] - weeks[earlier] > max_advance_weeks or overflow <= 0:
+                    break
+                spare_by_factory = capacity - load_of(earlier)
+                spare = spare_by_factory.sum()
+                if spare <= 0:
+                    continue
+                chosen = members[_pick_orders(amounts[members], min(overflow, spare), spare)]
+                week[chosen] = weeks[earlier]
+                # 提前的訂單先放到餘裕較多的工廠，比例交給下面逐週調整
+                factory[chosen] = int(np.argmax(spare_by_factory))
+                members = np.setdiff1d(members, chosen)
+                overflow -= amounts[chosen].sum()
+    
+    # 逐週調整工廠：比例工廠的合計超出目標區間時，只移轉補足差距所需的訂單
+    rows = []
+    for position, w in enumerate(weeks):
+        before = load_of(position)
+        side_a, side_b = plan.sides(before)
+        low, high, status = _factory_target(side_a + side_b, upper, lower, capacity_a, capacity_b, plan.share)
+        this_week = valid & (week == w)
+        if side_a > high and plan.b:
+            members = np.flatnonzero(this_week & (factory == plan.a))
+            chosen = members[_pick_orders(amounts[members], side_a - high, side_a - low)]
+            # 依序放到 B 側當時餘裕最多的工廠
+            spare = capacity[plan.b] - before[plan.b]
+            for idx in chosen:
+                target = int(np.argmax(spare))
+                factory[idx] = plan.b[target]
+                spare[target] -= amounts[idx]
+        elif side_a < low:
+            members = np.flatnonzero(this_week & np.isin(factory, plan.b))
+            chosen = members[_pick_orders(amounts[members], low - side_a, high - side_a)]
+            factory[chosen] = plan.a
+        after = load_of(position)
+        after_a, after_b = plan.sides(after)
+        if status == '符合' and not (low - 1e-6 <= after_a <= high + 1e-6):
+            status = '訂單不足以調整'
+        over = np.maximum(after - capacity, 0)
+        if status == '符合' and (over > 1e-6).any():
+            status = '產能不足'
+        row = {'日期區間': WEEKS.label(int(w))}
+        row.update({f'{label}合計材數(調整前)': value for label, value in zip(factories.labels, before)})
+        row.update({f'{label}合計材數(調整後)': value for label, value in zip(factories.labels, after)})
+        row['合計材數比例(調整前)'] = float(plan.ratio(side_a, side_b))
+        row['合計材數比例(調整後)'] = float(plan.ratio(after_a, after_b))
+        row['超出產能材數'] = float(over.sum())
+        row['狀態'] = status
+        rows.append(row)
+    
+    result = orders.reset_index(drop=True).copy()
+    result['原工廠'] = result['工廠']
+    result['原日期區間'] = [WEEKS.label(int(w)) if v else '' for w, v in zip(original_week, valid)]
+    result['建議工廠'] = pd.Categorical.from_codes(factory, factories.labels) if len(result) else result['工廠']
+    result['建議日期區間'] = [WEEKS.label(int(w)) if v else '' for w, v in zip(week, valid)]
+    result['是否調整'] = valid & ((factory != original_factory) | (week != original_week))
+    result = result.drop(columns=['工廠'])
+    return result, pd.DataFrame(rows)
+
 
 class FactoryComparison:
     def __init__(self):
-        self.factory1_data = {}  # 彰化廠
-        self.factory2_data = {}  # 台南廠
-        self.conn = None
+        self.factories = FactoryRegistry.load()  # 工廠登錄（代碼、名稱、產能、顏色、預估訂單查詢表）
+        self.actual_weeks = {}  # 各週實際材數：週序號 -> (工廠 × 門市類別) 陣列，增量更新時只重算受影響的週
+        self.actual_months = {}  # 各月實際材數：月序號 -> (工廠 × 門市類別) 陣列
+        self.db_source = None  # ev1020 主資料庫
+        self.estimated_source = None  # 預估訂單資料庫
+        self._source_lock = threading.Lock()  # 多個執行緒同時讀取查詢表時只建立一個資料來源
         self.config_file = 'database_config.json'
         self.excel_config_file = 'excel_config.json'
         self.db_path = self.load_db_path()
+        self.horizon_weeks = self.load_horizon_weeks()  # 查詢往後幾週，None 表示不限
+        self.fetch_batch_size = self.load_fetch_batch_size()  # 每批 fetchmany 筆數
         self.excel_path = self.load_excel_path()
-        self.date_ranges = {}
-        self.estimated_orders = {}  # 儲存預估訂單數據
+        self.date_ranges = {}  # 有數據的週：週序號 -> 日期區間標籤
+        self.estimated_orders = normalize_estimated_orders(pd.DataFrame(), self.factories)  # 儲存預估訂單數據
+        self.estimated_signature = None  # 目前預估訂單讀取時的來源檔案簽章
         # 添加預設比例設定
         self.ratio_settings = self.load_ratio_settings()
-        self.factory1_estimated_capacity = 1000  # 彰化廠每週預估材數
-        self.factory2_estimated_capacity = 1200  # 台南廠每週預估材數
         self.main_data_df = None
+        self.data_lock = threading.RLock()  # 背景載入交付新資料與產生報表互斥，報表不會混到新舊兩份資料
+        self.data_version = 0  # 每次資料變動加一，用來判斷彙總是否需要重建
+        self._cubes = None
+        self._cubes_version = None
+        self._report_model = None
+        self._drilldown = None
+        self._drilldown_version = None
+        self.cache_config_file = 'cache_config.json'
+        self.snapshot_cache = self.load_cache_settings()
+        self.state_file = 'ev1020_state.json'
+        self.ev1020_state = self.load_ev1020_state()  # 上次載入的範圍與每日摘要（增量更新用）
 
     def load_ratio_settings(self):
-        """載入比例設定"""
+        """載入比例設定（上下限、比例模式 pair/total、比例兩側的廠別代碼）"""
         try:
             if os.path.exists('ratio_settings.json'):
                 with open('ratio_settings.json', 'r') as f:
                     settings = json.load(f)
-                    # 若有最大產能設定則帶入
-                    if 'factory1_max_capacity' in settings:
-                        self.factory1_max_capacity = settings['factory1_max_capacity']
-                    if 'factory2_max_capacity' in settings:
-                        self.factory2_max_capacity = settings['factory2_max_capacity']
+                    # 舊版把兩廠最大產能存在這裡，工廠登錄沒有設定時帶入
+                    for idx, key in enumerate(['factory1_max_capacity', 'factory2_max_capacity']):
+                        value = settings.pop(key, None)
+                        if value and idx < len(self.factories) and not self.factories.entries[idx]['capacity']:
+                            self.factories.entries[idx]['capacity'] = value
                     return settings
         except:
             pass
@@ -54,6 +1841,78 @@ class FactoryComparison:
             pass
         return r'\\Windows-cqa6dgu\拆單軟體\eiffel.mdb'
 
+    def load_horizon_weeks(self):
+        """從配置檔案載入查詢結束範圍（週數）"""
+        try:
+            if os.path.exists(self.config_file):
+                with open(self.config_file, 'r') as f:
+                    return json.load(f).get('horizon_weeks')
+        except:
+            pass
+        return None
+
+    def load_fetch_batch_size(self):
+        """從配置檔案載入每批讀取筆數"""
+        try:
+            if os.path.exists(self.config_file):
+                with open(self.config_file, 'r') as f:
+                    return int(json.load(f).get('fetch_batch_size', 50000))
+        except:
+            pass
+        return 50000
+
+    def load_cache_settings(self):
+        """載入本機快照快取設定（位置、容量上限），停用時回傳 None"""
+        config = {}
+        try:
+            if os.path.exists(self.cache_config_file):
+                with open(self.cache_config_file, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+        except:
+            pass
+        if not config.get('enabled', True):
+            return None
+        default_dir = os.path.join(os.environ.get('LOCALAPPDATA') or os.path.expanduser('~'),
+                                   'FactoryComparison', 'cache')
+        cache_dir = config.get('cache_dir', default_dir)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except Exception as e:
+            print(f"無法建立快取資料夾，停用本機快照：{str(e)}")
+            return None
+        return SnapshotCache(cache_dir, int(config.get('max_mb', 512)) * 1024 * 1024)
+
+    def _source_signature(self, path):
+        """取得來源檔案簽章，無法取得時回傳 None"""
+        try:
+            return source_signature(path)
+        except OSError:
+            return None
+
+    def load_ev1020_state(self):
+        """載入上次 ev1020 載入狀態（資料庫路徑、查詢範圍、每日摘要）"""
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                    state['digest'] = {(day, factory): (count, total)
+                                       for day, factory, count, total in state.get('digest', [])}
+                    return state
+        except:
+            pass
+        return None
+
+    def save_ev1020_state(self):
+        """保存 ev1020 載入狀態，供下次增量更新比對"""
+        try:
+            state = dict(self.ev1020_state)
+            state['digest'] = [[day, factory, count, total]
+                               for (day, factory), (count, total) in sorted(state['digest'].items())]
+            with open(self.state_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+        except Exception as e:
+            print(f"保存載入狀態時出錯：{str(e)}")
+
     def load_excel_path(self):
         """從配置檔案載入預估訂單資料庫路徑（ACCDB/MDB）"""
         try:
@@ -68,8 +1927,14 @@ class FactoryComparison:
     def save_db_path(self):
         """保存資料庫路徑到配置檔案"""
         try:
+            # 保留配置檔中的其他設定（查詢範圍、每批筆數等）
+            config = {}
+            if os.path.exists(self.config_file):
+                with open(self.config_file, 'r') as f:
+                    config = json.load(f)
+            config['db_path'] = self.db_path
             with open(self.config_file, 'w') as f:
-                json.dump({'db_path': self.db_path}, f)
+                json.dump(config, f)
         except Exception as e:
             print(f"保存資料庫路徑時出錯：{str(e)}")
 
@@ -82,20 +1947,23 @@ class FactoryComparison:
             print(f"保存預估訂單資料庫路徑時出錯：{str(e)}")
 
     def save_ratio_settings(self):
-        """保存比例設定（含最大產能）"""
+        """保存比例設定；最大產能存在工廠登錄設定檔"""
         try:
-            # 一併存最大產能
-            self.ratio_settings['factory1_max_capacity'] = getattr(self, 'factory1_max_capacity', None)
-            self.ratio_settings['factory2_max_capacity'] = getattr(self, 'factory2_max_capacity', None)
             with open('ratio_settings.json', 'w') as f:
                 json.dump(self.ratio_settings, f)
+            self.factories.save()
             print("比例設定已保存")
         except Exception as e:
             print(f"保存比例設定時出錯：{str(e)}")
 
+    def get_ratio_plan(self):
+        """依比例設定取得比例兩側的工廠"""
+        return RatioPlan.from_settings(self.factories, self.ratio_settings)
+
     def select_database(self):
         """選擇資料庫檔案"""
         try:
+            tk, filedialog = load_filedialog()
             root = tk.Tk()
             root.attributes('-topmost', True)
             root.withdraw()
@@ -105,7 +1973,7 @@ class FactoryComparison:
             file_path = filedialog.askopenfilename(
                 title='選擇資料庫檔案',
                 initialdir=initial_dir,
-                filetypes=[('Access Database', '*.mdb'), ('All files', '*.*')],
+                filetypes=[('Access Database', '*.mdb'), ('SQLite/DuckDB', '*.sqlite;*.sqlite3;*.db;*.duckdb'), ('All files', '*.*')],
                 parent=root
             )
             
@@ -124,6 +1992,7 @@ class FactoryComparison:
     def select_excel_file(self):
         """選擇預估訂單ACCDB檔案"""
         try:
+            tk, filedialog = load_filedialog()
             root = tk.Tk()
             root.attributes('-topmost', True)
             root.withdraw()
@@ -131,7 +2000,7 @@ class FactoryComparison:
             file_path = filedialog.askopenfilename(
                 title='選擇預估訂單ACCDB檔案',
                 initialdir=initial_dir,
-                filetypes=[('Access Database', '*.accdb;*.mdb'), ('All files', '*.*')],
+                filetypes=[('Access Database', '*.accdb;*.mdb'), ('SQLite/DuckDB', '*.sqlite;*.sqlite3;*.db;*.duckdb'), ('All files', '*.*')],
                 parent=root
             )
             root.destroy()
@@ -144,134 +2013,385 @@ class FactoryComparison:
             print(f"選擇預估訂單資料庫檔案時發生錯誤：{str(e)}")
             return False
 
-    def connect_to_database(self):
-        """連接到 Access 資料庫"""
+    @traced('連接資料庫')
+    def connect_to_database(self, interactive=True):
+        """連接到主資料庫（依副檔名使用 Access、SQLite 或 DuckDB），連線保留在連線池重複使用"""
         try:
-            conn_str = (
-                r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};'
-                f'DBQ={self.db_path};'
-            )
-            self.conn = pyodbc.connect(conn_str)
+            if self.db_source is not None:
+                self.db_source.close()
+            self.db_source = create_data_source(self.db_path)
+            with self.db_source.connection():
+                pass
             print("成功連接到資料庫！")
             return True
         except Exception as e:
             print(f"連接資料庫時出錯：{str(e)}")
+            if not interactive:
+                return False
             retry = input("是否要重新選擇資料庫路徑？(y/n): ")
             if retry.lower() == 'y':
                 if self.select_database():
                     return self.connect_to_database()
             return False
 
-    def load_data_from_database(self):
-        """從資料庫載入數據"""
+    def get_estimated_source(self):
+        """取得預估訂單資料庫的資料來源，路徑不變時沿用同一個連線池（執行緒池同時呼叫也只建立一次）"""
+        with self._source_lock:
+            if self.estimated_source is None or self.estimated_source.path != self.excel_path:
+                if self.estimated_source is not None:
+                    self.estimated_source.close()
+                self.estimated_source = create_data_source(self.excel_path)
+            return self.estimated_source
+
+    def close(self):
+        """關閉所有資料來源的連線"""
+        for source in (self.db_source, self.estimated_source):
+            if source is not None:
+                source.close()
+
+    def mirror_databases(self, target_dir):
+        """把 ev1020 與預估訂單查詢表複製成本機 SQLite 鏡像，回傳兩個鏡像檔路徑"""
+        os.makedirs(target_dir, exist_ok=True)
+        db_mirror = os.path.join(target_dir, 'eiffel_mirror.sqlite')
+        estimated_mirror = os.path.join(target_dir, 'estimated_mirror.sqlite')
+        mirror_to_sqlite(self.db_source, db_mirror, ['ev1020'])
+        mirror_to_sqlite(self.get_estimated_source(), estimated_mirror, [table for table, _ in self.factories.tables])
+        return db_mirror, estimated_mirror
+
+    def get_data_window(self):
+        """取得查詢的日期範圍：從當週（或當月，供月圖使用）開始，到設定的週數為止"""
+        now = pd.Timestamp.now()
+        week_start = get_week_start(now)
+        # 月圖從今天所在的月份開始；週一若還在上個月，不必多讀上個月的數據
+        start = min(week_start, now.normalize().replace(day=1))
+        end = week_start + pd.Timedelta(weeks=self.horizon_weeks) if self.horizon_weeks else None
+        return start, end
+
+    @traced('串流讀取ev1020', rows_out=len)
+    def query_ev1020(self, columns=None, start_date=None, end_date=None, source=None, dates=None,
+                     digest=None, capacity=0):
+        """以參數化查詢分批串流讀取 ev1020（日期範圍與欄位在 SQL 端過濾），欄位直接轉成精簡型別"""
+        query, params = build_ev1020_query(columns, start_date, end_date, dates)
+        batches = (source or self.db_source).iter_batches(query, params, self.fetch_batch_size)
+        job = BackgroundJob.current()
+        if job is not None:
+            batches = job.track(batches, '串流讀取ev1020')
+        return read_compact_frame(batches, EV1020_DTYPES, capacity, digest)
+
+    def _expected_rows(self):
+        """依上次載入的摘要估計筆數，用來預先配置緩衝區"""
+        if not self.ev1020_state:
+            return 0
+        return int(sum(count for count, _ in self.ev1020_state['digest'].values()) * 1.1)
+
+    @traced('查詢每日摘要', rows_out=len)
+    def query_ev1020_digest(self, start_date=None, end_date=None, source=None):
+        """向資料庫查詢每日摘要（只回傳每日每廠一列，不取明細）"""
+        query, params = build_ev1020_digest_query(start_date, end_date)
+        rows = (source or self.db_source).query(query, params)
+        return {
+            (pd.Timestamp(day).isoformat(), str(factory)): (int(count), round(float(total or 0), 3))
+            for day, factory, count, total in rows.itertuples(index=False, name=None)
+        }
+
+    @traced('讀取異動日期', rows_in=lambda self, dates, *args, **kwargs: len(dates), rows_out=len)
+    def query_ev1020_dates(self, dates, columns=None, source=None, batch_size=100):
+        """讀取指定出貨日期的明細，IN 條件分批送出避免參數過多"""
+        frames = [self.query_ev1020(columns, dates=dates[i:i + batch_size], source=source)
+                  for i in range(0, len(dates), batch_size)]
+        if not frames:
+            return pd.DataFrame(columns=list(columns or EV1020_COLUMNS))
+        return concat_compact(frames)
+
+    @traced('分期加總', rows_in=lambda self, df, calendar: len(df), rows_out=len)
+    def _aggregate_periods(self, df, calendar):
+        """依期間序號、廠別與門市類別一次加總所有登錄工廠的實際材數，
+        回傳 {期間序號: (工廠 × 門市類別) 陣列}（只含有數據的期間）"""
+        shape = (len(self.factories), len(AggregationCube.CATEGORIES))
+        periods = calendar.ordinals(df['出貨日期'])
+        factory = self.factories.lookup(df['廠別'])
+        valid = (periods != PeriodCalendar.INVALID) & (factory >= 0)
+        keys, inverse = np.unique(periods[valid], return_inverse=True)
+        category = classify_store_codes(df['門市代號'])[valid]
+        flat = (inverse.astype(np.int64) * shape[0] + factory[valid]) * shape[1] + category
+        amounts = np.nan_to_num(df['材數'].to_numpy(dtype='float64')[valid])
+        totals = np.bincount(flat, weights=amounts, minlength=len(keys) * shape[0] * shape[1])
+        totals = totals.reshape(-1, *shape)
+        return {int(key): totals[i] for i, key in enumerate(keys)}
+
+    def has_factory_data(self):
+        """是否已載入任一工廠當週以後的數據"""
+        return bool(self.actual_weeks)
+
+    def _remember_load(self, start_date, end_date, digest, signature=None, snapshot=True):
+        """記錄本次載入的範圍、來源簽章與摘要，並寫入狀態檔，同時更新本機快照"""
+        if snapshot and self.snapshot_cache and signature:
+            self.snapshot_cache.put('ev1020', self.db_path, self.main_data_df[MAIN_DATA_COLUMNS],
+                                    self._ev1020_cache_params(start_date, end_date), signature)
+        self.ev1020_state = {
+            'db_path': self.db_path,
+            'source': signature,
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat() if end_date is not None else None,
+            'loaded_at': datetime.now().isoformat(timespec='seconds'),
+            'digest': digest,
+        }
+        self.save_ev1020_state()
+
+    def _ev1020_cache_params(self, start_date, end_date):
+        """ev1020 快照對應的查詢參數，範圍不同的快照不可沿用"""
+        return {'columns': MAIN_DATA_COLUMNS,
+                'start_date': start_date.isoformat(),
+                'end_date': end_date.isoformat() if end_date is not None else None}
+
+    @traced('載入主資料')
+    def load_data_from_database(self, use_cache=True):
+        """從資料庫載入數據（來源檔案未變動時直接讀本機快照）；全部計算完成才更新物件狀態"""
         try:
-            cursor = self.conn.cursor()
-            query = """
-            SELECT 
-                ev1020_03 as 出貨日期,
-                ev1020_88 as 廠別,
-                ev1020_07 as 材數,
-                ev1020_13 as 生產性質,
-                ev1020_20 as 門市,
-                ev1020_11 as 圖號,
-                ev1020_12 as 色號,
-                ev1020_19 as 客戶,
-                ev1020_06 as 拆單人員,
-                ev1020_09 as 重量,
-                ev1020_05 as 門市代號
-            FROM ev1020
-            WHERE ev1020_13 LIKE '%生產%'
-            """
+            start_date, end_date = self.get_data_window()
+            df = None
+            if use_cache and self.snapshot_cache:
+                df = self.snapshot_cache.get('ev1020', self.db_path,
+                                             self._ev1020_cache_params(start_date, end_date))
+            from_snapshot = df is not None
+            if from_snapshot:
+                signature = self._source_signature(self.db_path)
+                state = self.ev1020_state
+                # 快照與狀態檔記錄的是同一次載入時沿用其摘要，否則向資料庫查詢摘要
+                if (state and state.get('db_path') == self.db_path and state.get('source') == signature
+                        and state.get('start_date') == start_date.isoformat()):
+                    digest = state['digest']
+                else:
+                    digest = self.query_ev1020_digest(start_date, end_date)
+                print("資料庫未變動，使用本機快照")
+            else:
+                # 先取來源簽章再查詢，查詢期間若有寫入，下次即會判定為已變動
+                signature = self._source_signature(self.db_path)
+                # 一次取回報表、圖表與明細下鑽需要的欄位，之後不必再查詢；摘要在串流時一併累加
+                accumulator = DigestAccumulator()
+                df = self.query_ev1020(MAIN_DATA_COLUMNS, start_date, end_date,
+                                       digest=accumulator, capacity=self._expected_rows())
+                digest = accumulator.result()
             
-            cursor.execute(query)
-            columns = [column[0] for column in cursor.description]
-            rows = cursor.fetchall()
+            # 當月月初可能早於當週，週統計只保留當週以後的數據
+            current = df[df['出貨日期'] >= get_week_start()]
             
-            df = pd.DataFrame.from_records(rows, columns=columns)
-            df['出貨日期'] = pd.to_datetime(df['出貨日期'])
+            # 依據週（當週以後）與月分組計算實際材數（所有工廠一次彙總），報表直接使用
+            actual_weeks = self._aggregate_periods(current, WEEKS)
+            actual_months = self._aggregate_periods(df, MONTHS)
             
-            # 獲取當前日期
-            current_date = pd.Timestamp.now()
+            # 有數據的週：週序號 -> 日期區間標籤（序號可直接排序）
+            date_ranges = {week: WEEKS.label(week) for week in sorted(actual_weeks)}
             
-            # 過濾只保留當週以後的數據
-            df = df[df['出貨日期'] >= current_date.normalize() - pd.Timedelta(days=current_date.dayofweek)]
+            # 全部計算完成後才一次更新，載入失敗或取消時保留原本的數據
+            with self.data_lock:
+                self.main_data_df = df
+                self.actual_weeks, self.actual_months = actual_weeks, actual_months
+                self.date_ranges = date_ranges
+                self.data_version += 1
+            # 新資料已交付，寫入狀態檔與快照時不再檢查取消（也不佔用 data_lock）
+            with BackgroundJob.binding(None):
+                self._remember_load(start_date, end_date, digest, signature, snapshot=not from_snapshot)
             
-            if df.empty:
+            if current.empty:
                 print("警告：沒有找到當週以後的數據")
-                return
+            else:
+                print("成功從資料庫載入數據！")
+            return True
             
-            # 計算每筆資料所屬的週起始日和週結束日
-            df['週起始日'] = df['出貨日期'].dt.to_period('W').dt.start_time
-            df['週結束日'] = df['出貨日期'].dt.to_period('W').dt.end_time
-            df['日期區間'] = df['週起始日'].dt.strftime('%Y/%m/%d') + '-' + df['週結束日'].dt.strftime('%Y/%m/%d')
+        except Exception as e:
+            print(f"載入數據時出錯：{str(e)}")
+            return False
+
+    @traced('增量更新')
+    def refresh_data_from_database(self):
+        """增量更新：只重新讀取摘要有變動的出貨日，並只重算受影響的週"""
+        state = self.ev1020_state
+        if self.main_data_df is None or not state or state.get('db_path') != self.db_path:
+            return self.load_data_from_database()
+        try:
+            start_date, end_date = self.get_data_window()
+            signature = self._source_signature(self.db_path)
+            if (signature and signature == state.get('source')
+                    and state.get('start_date') == start_date.isoformat()
+                    and state.get('end_date') == (end_date.isoformat() if end_date is not None else None)):
+                print("資料庫檔案未變動，沿用已載入的數據")
+                return True
+            digest = self.query_ev1020_digest(start_date, end_date)
+            dates = changed_dates(state['digest'], digest)
+            if not dates:
+                self._remember_load(start_date, end_date, digest, signature)
+                print("資料庫沒有異動，沿用已載入的數據")
+                return True
             
-            # 依據廠別和日期區間分組計算總材數
-            factory1_data = df[df['廠別'] == '001'].groupby(['日期區間', '週起始日'])['材數'].sum()
-            factory2_data = df[df['廠別'] == '002'].groupby(['日期區間', '週起始日'])['材數'].sum()
+            # 換掉有異動的日期；已移出查詢範圍的舊日期只需移除，不再重新讀取
+            delta = self.query_ev1020_dates([day for day in dates if day >= start_date], MAIN_DATA_COLUMNS)
+            main_data = self.main_data_df[list(MAIN_DATA_COLUMNS)]
+            main_data = main_data[~main_data['出貨日期'].isin(dates) & (main_data['出貨日期'] >= start_date)]
+            main_data = concat_compact([main_data, delta])
             
-            # 轉換為字典格式，使用日期區間作為鍵
-            self.factory1_data = {idx[0]: weight for idx, weight in factory1_data.items()}
-            self.factory2_data = {idx[0]: weight for idx, weight in factory2_data.items()}
+            # 只重算受影響的週與月，並移除當週以前的舊週與查詢範圍以前的舊月
+            week_start = get_week_start()
+            changed = pd.DatetimeIndex(dates)
+            affected = np.unique(WEEKS.ordinals(changed))
+            current = main_data[main_data['出貨日期'] >= week_start]
+            current = current[np.isin(WEEKS.ordinals(current['出貨日期']), affected)]
+            stale = set(affected.tolist())
+            actual_weeks = {week: values for week, values in self.actual_weeks.items()
+                            if week not in stale and week >= WEEKS.ordinal(week_start)}
+            actual_weeks.update(self._aggregate_periods(current, WEEKS))
+            affected_months = np.unique(MONTHS.ordinals(changed))
+            months = main_data[np.isin(MONTHS.ordinals(main_data['出貨日期']), affected_months)]
+            stale = set(affected_months.tolist())
+            actual_months = {month: values for month, values in self.actual_months.items()
+                             if month not in stale and month >= MONTHS.ordinal(start_date)}
+            actual_months.update(self._aggregate_periods(months, MONTHS))
+            date_ranges = {week: WEEKS.label(week) for week in sorted(actual_weeks)}
             
-            # 儲存所有日期區間的週起始日，用於後續排序
-            self.date_ranges = {idx[0]: idx[1] for idx in factory1_data.index.union(factory2_data.index)}
+            # 全部計算完成後才一次更新
+            with self.data_lock:
+                self.main_data_df = main_data
+                self.actual_weeks, self.actual_months = actual_weeks, actual_months
+                self.date_ranges = date_ranges
+                self.data_version += 1
+            with BackgroundJob.binding(None):
+                self._remember_load(start_date, end_date, digest, signature)
             
-            print("成功從資料庫載入數據！")
-            cursor.close()
+            print(f"增量更新完成：{len(dates)} 個出貨日有異動，重新讀取 {len(delta)} 筆，更新 {len(affected)} 週")
+            return True
             
         except Exception as e:
-            print(f"載入數據時出錯：{str(e)}")
+            print(f"增量更新時出錯：{str(e)}，改為完整重新載入")
+            return self.load_data_from_database()
 
     def load_estimated_orders(self):
         """（保留空函式，避免主程式報錯）"""
         print("本系統僅支援ACCDB預估訂單數據，請用功能7直接載入。")
         return False
 
-    def load_estimated_orders_from_accdb(self):
-        """從 ACCDB/MDB 資料庫讀取預估訂單數據（彰化查詢、台南查詢）"""
+    @traced('讀取預估訂單表', rows_out=len)
+    def _read_estimated_table(self, table, factory_name, use_cache=True):
+        """讀取一個預估訂單查詢表（檔案未變動時讀本機快照），欄位整理成預估訂單格式"""
+        df = None
+        if use_cache and self.snapshot_cache:
+            df = self.snapshot_cache.get(table, self.excel_path)
+        if df is None:
+            signature = self._source_signature(self.excel_path)
+            df = self.get_estimated_source().read_table(table)
+            if self.snapshot_cache and signature:
+                self.snapshot_cache.put(table, self.excel_path, df, signature=signature)
+        return pd.DataFrame({
+            '日期': df['預計出貨日'],
+            '門市': df['門市'],  # 保留原本內容
+            '門市代號': df['門市代號'] if '門市代號' in df.columns else '',
+            '預估材數': df['預估材數'],
+            '備註': df['備註'] if '備註' in df.columns else '',
+            '工廠': factory_name
+        })
+
+    @traced('整理預估訂單', rows_in=lambda self, frames, *args, **kwargs: sum(len(frame) for frame in frames))
+    def _apply_estimated_orders(self, frames, signature=None):
+        """所有查詢表都讀取成功後才更新預估訂單；signature 為讀取前取得的來源檔案簽章"""
+        orders = normalize_estimated_orders(pd.concat(frames, ignore_index=True), self.factories)
+        with self.data_lock:
+            self.estimated_orders = orders
+            self.estimated_signature = signature
+            self.data_version += 1
+        print(f"成功從預估訂單ACCDB載入{len(self.estimated_orders)}筆預估訂單數據")
+
+    def load_estimated_orders_from_accdb(self, use_cache=True):
+        """從 ACCDB/MDB 資料庫讀取預估訂單數據（各廠的查詢表），檔案未變動時讀本機快照"""
         try:
             if not os.path.exists(self.excel_path):
                 print(f"未找到預估訂單ACCDB檔案：{self.excel_path}")
                 return False
-            conn_str = (
-                r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};'
-                f'DBQ={self.excel_path};'
-            )
-            conn = pyodbc.connect(conn_str)
-            orders = []
-            for table, factory_name in [('彰化查詢', '彰化廠'), ('台南查詢', '台南廠')]:
-                query = f"SELECT * FROM [{table}]"
-                df = pd.read_sql(query, conn)
-                for _, row in df.iterrows():
-                    orders.append({
-                        '日期': row['預計出貨日'],
-                        '門市': row['門市'],  # 保留原本內容
-                        '門市代號': row['門市代號'] if '門市代號' in row else '',
-                        '預估材數': row['預估材數'],
-                        '備註': row['備註'] if '備註' in row else '',
-                        '工廠': factory_name
-                    })
-            conn.close()
-            self.estimated_orders = orders
-            print(f"成功從預估訂單ACCDB載入{len(self.estimated_orders)}筆預估訂單數據")
+            signature = self._source_signature(self.excel_path)
+            frames = [self._read_estimated_table(table, factory_name, use_cache)
+                      for table, factory_name in self.factories.tables]
+            self._apply_estimated_orders(frames, signature)
             return True
         except Exception as e:
             print(f"從預估訂單ACCDB載入預估訂單數據時發生錯誤：{str(e)}")
             return False
 
+    def refresh_estimated_orders(self):
+        """預估訂單資料庫檔案未變動時沿用已載入的預估訂單（資料版本不變，快取的報表與圖表都可沿用），否則重新讀取"""
+        signature = self._source_signature(self.excel_path)
+        if signature and signature == self.estimated_signature:
+            return True
+        return self.load_estimated_orders_from_accdb()
+
+    def load_all(self, use_cache=True):
+        """以執行緒池同時載入主資料庫與各廠預估訂單查詢表（各自使用獨立連線）
+        回傳 {來源: {'ok': 是否成功, 'seconds': 耗時}}"""
+        timings = {}
+        job = BackgroundJob.current()
+        
+        def timed(name, func, *args):
+            start = time.perf_counter()
+            try:
+                with BackgroundJob.binding(job):
+                    return func(*args)
+            finally:
+                timings[name] = time.perf_counter() - start
+        
+        load_main = self.refresh_data_from_database if use_cache else (lambda: self.load_data_from_database(use_cache=False))
+        load_estimated = os.path.exists(self.excel_path)
+        estimated_signature = self._source_signature(self.excel_path) if load_estimated else None
+        if not load_estimated:
+            print(f"未找到預估訂單ACCDB檔案：{self.excel_path}")
+        tables = self.factories.tables
+        with ThreadPoolExecutor(max_workers=1 + len(tables)) as pool:
+            main_future = pool.submit(timed, 'ev1020', load_main)
+            table_futures = [(table, pool.submit(timed, table, self._read_estimated_table, table, factory_name, use_cache))
+                             for table, factory_name in tables] if load_estimated else []
+            results = {'ev1020': {'ok': bool(main_future.result())}}
+            frames, errors = [], []
+            for table, future in table_futures:
+                try:
+                    frames.append(future.result())
+                    results[table] = {'ok': True}
+                except Exception as e:
+                    errors.append(f"{table}：{str(e)}")
+                    results[table] = {'ok': False}
+        
+        # 任一查詢表失敗時保留原本的預估訂單，避免只更新一半
+        if errors:
+            print("從預估訂單ACCDB載入預估訂單數據時發生錯誤，保留原本的預估訂單：" + '；'.join(errors))
+        elif load_estimated:
+            self._apply_estimated_orders(frames, estimated_signature)
+        
+        for table, _ in tables:
+            results.setdefault(table, {'ok': False})
+        for name, result in results.items():
+            result['seconds'] = timings.get(name, 0.0)
+        print("各來源載入時間：" + '，'.join(f"{name} {result['seconds']:.2f} 秒" for name, result in results.items()))
+        if not results['ev1020']['ok']:
+            print("主資料庫載入失敗，保留原本的數據")
+        return results
+
+    def force_refresh(self):
+        """刪除本機快照，重新從兩個資料庫完整載入並重建快照"""
+        if self.snapshot_cache:
+            self.snapshot_cache.clear()
+        return self.load_all(use_cache=False)
+
     def set_ratio_settings(self):
         """設定比例"""
         try:
+            # 目前的上下限可能不符合比例模式（例如 total 模式沿用 2.2/1.8），這裡正是要重新設定，所以不檢查
+            plan = RatioPlan.from_settings(self.factories, self.ratio_settings, check=False)
             print("\n=== 目前的比例設定 ===")
-            print(f"材數比例 > {self.ratio_settings['upper']} 時，建議分配給台南廠")
-            print(f"材數比例 < {self.ratio_settings['lower']} 時，建議分配給彰化廠")
+            print(f"材數比例：{plan.describe()}（模式與比較的工廠在 ratio_settings.json 的 mode、pair 設定）")
+            print(f"材數比例 > {self.ratio_settings['upper']} 時，建議分配給{plan.b_label}")
+            print(f"材數比例 < {self.ratio_settings['lower']} 時，建議分配給{plan.a_label}")
             
             # 輸入新的上限值
             while True:
                 try:
-                    upper = float(input("\n請輸入新的上限值（建議分配給台南廠的比例）："))
-                    if upper <= 0:
-                        print("比例必須大於0")
+                    upper = float(input(f"\n請輸入新的上限值（建議分配給{plan.b_label}的比例）："))
+                    if not plan.valid_threshold(upper):
+                        print(f"比例必須{plan.threshold_range()}")
                         continue
                     break
                 except ValueError:
@@ -280,9 +2400,9 @@ class FactoryComparison:
             # 輸入新的下限值
             while True:
                 try:
-                    lower = float(input("請輸入新的下限值（建議分配給彰化廠的比例）："))
-                    if lower <= 0:
-                        print("比例必須大於0")
+                    lower = float(input(f"請輸入新的下限值（建議分配給{plan.a_label}的比例）："))
+                    if not plan.valid_threshold(lower):
+                        print(f"比例必須{plan.threshold_range()}")
                         continue
                     if lower >= upper:
                         print("下限值必須小於上限值")
@@ -296,8 +2416,8 @@ class FactoryComparison:
             self.save_ratio_settings()
             
             print("\n=== 新的比例設定 ===")
-            print(f"材數比例 > {upper} 時，建議分配給台南廠")
-            print(f"材數比例 < {lower} 時，建議分配給彰化廠")
+            print(f"材數比例 > {upper} 時，建議分配給{plan.b_label}")
+            print(f"材數比例 < {lower} 時，建議分配給{plan.a_label}")
             
             return True
             
@@ -306,401 +2426,1159 @@ class FactoryComparison:
             return False
 
     def set_max_capacity(self):
-        """設定彰化廠、台南廠每週最大材數，並持久化"""
+        """設定各廠每週最大材數（存在工廠登錄），並持久化"""
         try:
             print("\n=== 設定每週最大材數 ===")
-            c1 = input(f"請輸入彰化廠每週最大材數 (目前: {getattr(self, 'factory1_max_capacity', '未設定')}): ")
-            c2 = input(f"請輸入台南廠每週最大材數 (目前: {getattr(self, 'factory2_max_capacity', '未設定')}): ")
-            self.factory1_max_capacity = int(c1) if c1.strip() else getattr(self, 'factory1_max_capacity', 0)
-            self.factory2_max_capacity = int(c2) if c2.strip() else getattr(self, 'factory2_max_capacity', 0)
-            print(f"彰化廠最大產能: {self.factory1_max_capacity}, 台南廠最大產能: {self.factory2_max_capacity}")
+            for entry, label in zip(self.factories.entries, self.factories.labels):
+                value = input(f"請輸入{label}每週最大材數 (目前: {entry['capacity'] or '未設定'}): ")
+                if value.strip():
+                    entry['capacity'] = int(value) or None
+            print('，'.join(f"{label}最大產能: {entry['capacity'] or '未設定'}"
+                           for entry, label in zip(self.factories.entries, self.factories.labels)))
             self.save_ratio_settings()  # 設定後自動保存
         except Exception as e:
             print(f"設定最大產能時發生錯誤：{str(e)}")
 
+    @traced('建立彙總')
+    @holding_data_lock
+    def get_cubes(self):
+        """取得週與月的彙總陣列，資料未變動時沿用上次結果"""
+        if self._cubes is not None and self._cubes_version == self.data_version:
+            return self._cubes
+        orders = self.estimated_orders
+        
+        # 實際材數沿用載入與增量更新時維護的各週、各月彙總，只有預估訂單需要重新累加
+        estimated_factory = orders['工廠'].cat.codes.to_numpy()
+        estimated_category = classify_store_codes(orders['門市代號'])
+        
+        def sources(calendar):
+            return [(calendar.ordinals(orders['日期']), estimated_factory, estimated_category, 1, orders['預估材數'])]
+        
+        # 週：報表的週區間（當週以後有實際數據的週）
+        count = len(self.factories)
+        week_cube = AggregationCube.build(WEEKS, sorted(self.date_ranges), sources(WEEKS), count, self.actual_weeks)
+        # 月：當月起三個月
+        month = MONTHS.ordinal(pd.Timestamp.now())
+        month_cube = AggregationCube.build(MONTHS, [month, month + 1, month + 2], sources(MONTHS), count,
+                                           self.actual_months)
+        
+        self._cubes = {'week': week_cube, 'month': month_cube}
+        self._cubes_version = self.data_version
+        return self._cubes
+
+    @traced('建立報表', rows_out=lambda model: len(model.frame))
+    @holding_data_lock
+    def get_report_model(self):
+        """取得數值型報表；資料與比例設定都未變動時直接沿用快取，只有比例設定變動時只重算建議欄位"""
+        settings = (self.ratio_settings['upper'], self.ratio_settings['lower'])
+        plan = self.get_ratio_plan()
+        model = self._report_model
+        if model is not None and model.data_version == self.data_version and model.plan.key == plan.key:
+            if model.settings != settings:
+                self._report_model = model.with_settings(settings)
+            return self._report_model
+        
+        # 由彙總陣列取出各週各廠的實際與預估材數（已依週起始日排序），工廠欄位依登錄順序展開
+        cube = self.get_cubes()['week']
+        actual, estimated = cube.factory_metric(0), cube.factory_metric(1)
+        combined = actual + estimated
+        labels = self.factories.labels
+        columns = {'日期區間': cube.labels, '週起始日': cube.periods}
+        columns.update({f'{label}材數': actual[:, idx] for idx, label in enumerate(labels)})
+        columns.update({f'{label}預估材數': estimated[:, idx] for idx, label in enumerate(labels)})
+        # 計算合計材數
+        columns.update({f'{label}合計材數': combined[:, idx] for idx, label in enumerate(labels)})
+        df = pd.DataFrame(columns)
+        
+        # 計算材數差異和比例（使用比例兩側的合計材數）
+        side_a, side_b = plan.sides(combined)
+        df['比例工廠合計材數'] = side_a
+        df['對照工廠合計材數'] = side_b
+        df['合計材數差異'] = side_a - side_b
+        df['合計材數比例'] = plan.ratio(side_a, side_b)
+        
+        # 根據合計材數判斷訂單分配建議，並算出建議分配量的上下限（文字由各輸出端組合）
+        df['訂單分配建議'], df['建議分配下限'], df['建議分配上限'] = suggest_allocation(df, *settings, plan)
+        
+        self._report_model = ReportModel(df, self.data_version, settings, plan, report_numeric_columns(labels))
+        return self._report_model
+
+    @traced('輸出主控台報表', rows_out=len)
     def generate_report(self):
-        """生成比較報告"""
+        """生成比較報告（主控台用的文字報表）"""
         try:
-            # 獲取日期排序
-            date_ranges_with_dates = []
-            for date_range in set(self.factory1_data.keys()) | set(self.factory2_data.keys()):
-                start_date = datetime.strptime(date_range.split('-')[0], '%Y/%m/%d')
-                date_ranges_with_dates.append((date_range, start_date))
-            
-            # 按日期降序排序
-            all_date_ranges = [x[0] for x in sorted(date_ranges_with_dates, 
-                                                  key=lambda x: x[1], 
-                                                  reverse=False)]
-            
-            # 創建基礎DataFrame
-            df = pd.DataFrame({
-                '日期區間': all_date_ranges,
-                '彰化廠材數': [self.factory1_data.get(dr, 0) for dr in all_date_ranges],
-                '台南廠材數': [self.factory2_data.get(dr, 0) for dr in all_date_ranges]
-            })
-            
-            # 計算預估材數
-            def get_estimated_orders(start_date_str, end_date_str):
-                if not self.estimated_orders:
-                    return {'彰化': 0, '台南': 0}
-                start_date = datetime.strptime(start_date_str, '%Y/%m/%d')
-                end_date = datetime.strptime(end_date_str, '%Y/%m/%d')
-                factory1_sum = 0  # 彰化廠
-                factory2_sum = 0  # 台南廠
-                for order in self.estimated_orders:
-                    order_date = pd.to_datetime(order['日期']).to_pydatetime()
-                    if start_date <= order_date <= end_date:
-                        # 根據工廠欄位判斷
-                        if '工廠' in order and order['工廠'] == '彰化廠':
-                            factory1_sum += order['預估材數']
-                        elif '工廠' in order and order['工廠'] == '台南廠':
-                            factory2_sum += order['預估材數']
-                return {'彰化': factory1_sum, '台南': factory2_sum}
-            
-            # 添加預估材數列
-            df['彰化廠預估材數'] = df['日期區間'].apply(
-                lambda x: get_estimated_orders(x.split('-')[0], x.split('-')[1])['彰化'])
-            df['台南廠預估材數'] = df['日期區間'].apply(
-                lambda x: get_estimated_orders(x.split('-')[0], x.split('-')[1])['台南'])
-            
-            # 計算合計材數
-            df['彰化廠合計材數'] = df['彰化廠材數'] + df['彰化廠預估材數']
-            df['台南廠合計材數'] = df['台南廠材數'] + df['台南廠預估材數']
-            
-            # 計算材數差異和比例（使用合計材數）
-            df['合計材數差異'] = df['彰化廠合計材數'] - df['台南廠合計材數']
-            df['合計材數比例'] = df['彰化廠合計材數'] / df['台南廠合計材數'].replace(0, float('nan'))
-            
-            # 根據合計材數判斷訂單分配建議
-            def get_suggestion(row):
-                if pd.isna(row['合計材數比例']):
-                    return '無法計算'
-                elif row['合計材數比例'] > self.ratio_settings['upper']:
-                    return '建議分配給台南廠'
-                elif row['合計材數比例'] < self.ratio_settings['lower']:
-                    return '建議分配給彰化廠'
-                else:
-                    return '訂單分配正常'
-            
-            df['訂單分配建議'] = df.apply(get_suggestion, axis=1)
-
-            # 新增建議分配量欄位（依照新公式）
-            def get_suggested_amount(row):
-                try:
-                    c1 = float(row['彰化廠合計材數']) if isinstance(row['彰化廠合計材數'], (int, float)) else float(str(row['彰化廠合計材數']).replace(',', ''))
-                    c2 = float(row['台南廠合計材數']) if isinstance(row['台南廠合計材數'], (int, float)) else float(str(row['台南廠合計材數']).replace(',', ''))
-                    upper = self.ratio_settings['upper']
-                    lower = self.ratio_settings['lower']
-                    total = c1 + c2
-                    if row['訂單分配建議'] == '建議分配給台南廠':
-                        # 上限(2.2)：(A+B)/(1+2.2) - B
-                        up = total / (1 + upper) - c2
-                        # 下限(1.8)：(A+B)/(1+1.8) - B
-                        low = total / (1 + lower) - c2
-                        return f"建議分配到台南廠：{low:,.0f} ~ {up:,.0f} 材數"
-                    elif row['訂單分配建議'] == '建議分配給彰化廠':
-                        # 上限(2.2)：((A+B)/(1+2.2))*2.2 - A
-                        up = (total / (1 + upper)) * upper - c1
-                        # 下限(1.8)：((A+B)/(1+1.8))*1.8 - A
-                        low = (total / (1 + lower)) * lower - c1
-                        return f"建議分配到彰化廠：{low:,.0f} ~ {up:,.0f} 材數"
-                    elif row['訂單分配建議'] == '訂單分配正常':
-                        return '維持現有分配'
-                    else:
-                        return '-'
-                except Exception:
-                    return '-'
-            df['建議分配量'] = df.apply(get_suggested_amount, axis=1)
-            
-            # 設置日期區間為索引
-            df.set_index('日期區間', inplace=True)
-            
-            # 格式化數值列
-            numeric_columns = ['彰化廠材數', '台南廠材數', 
-                             '彰化廠預估材數', '台南廠預估材數',
-                             '彰化廠合計材數', '台南廠合計材數',
-                             '合計材數差異']
-            
-            for col in numeric_columns:
-                df[col] = df[col].map('{:,.0f}'.format)
-            
-            df['合計材數比例'] = df['合計材數比例'].map(lambda x: '{:.2f}'.format(x) if pd.notnull(x) else '-')
-            
-            # 若日期區間為index，重設為欄位並移到最左側
-            if '日期區間' not in df.columns and df.index.name == '日期區間':
-                df = df.reset_index()
-            # 強制欄位順序，日期區間在最左
-            col_order = ['日期區間'] + [col for col in df.columns if col != '日期區間']
-            df = df[col_order]
-            
-            return df
-            
+            return render_report_table(self.get_report_model())
         except Exception as e:
             print(f"生成報告時發生錯誤：{str(e)}")
             return pd.DataFrame()
 
-    def plot_comparison(self):
-        """繪製比較圖表"""
+    @traced('建立下鑽索引', rows_in=lambda self: len(self.main_data_df) if self.main_data_df is not None else 0)
+    @holding_data_lock
+    def get_drilldown(self):
+        """取得明細下鑽索引，資料未變動時沿用上次建立的索引"""
+        if self._drilldown is None or self._drilldown_version != self.data_version:
+            if self.main_data_df is None:
+                raise ValueError("尚未載入主資料，請先載入數據（選項1）")
+            # 只索引報表的週（主資料從月初開始，當週以前的列不列入）
+            self._drilldown = DrillDownIndex(self.main_data_df, self.factories, self.date_ranges)
+            self._drilldown_version = self.data_version
+        return self._drilldown
+
+    def drill_down(self, column='門市代號', week=None, factory=None, top=10, where=None, key=None):
+        """以已載入的明細下鑽（不重新查詢資料庫）：week 為週內任一天、factory 為廠別代碼或名稱、where 為 (維度, 值)
+        有 key 時回傳該值在各週各廠的材數，否則回傳材數最多的前 top 名；失敗時回傳 None"""
         try:
-            fig, (ax1, ax2, ax3, ax4) = plt.subplots(4, 1, figsize=(15, 24))
-            
-            # 設置中文字型
-            plt.rcParams['font.sans-serif'] = ['Microsoft JhengHei']
-            plt.rcParams['axes.unicode_minus'] = False
-            
-            df = self.generate_report().copy()
-            
-            # 將字符串格式的數值轉回浮點數
-            numeric_columns = ['彰化廠材數', '台南廠材數', 
-                             '彰化廠預估材數', '台南廠預估材數',
-                             '彰化廠合計材數', '台南廠合計材數']
-            
-            for col in numeric_columns:
-                df[col] = df[col].str.replace(',', '').astype(float)
-            
-            # 第一個子圖：實際材數和預估材數
-            ax1.plot(df['日期區間'], df['彰化廠材數'], 'b-', marker='o', label='彰化廠實際材數')
-            ax1.plot(df['日期區間'], df['台南廠材數'], 'r-', marker='o', label='台南廠實際材數')
-            ax1.plot(df['日期區間'], df['彰化廠預估材數'], 'b--', marker='^', label='彰化廠預估材數')
-            ax1.plot(df['日期區間'], df['台南廠預估材數'], 'r--', marker='^', label='台南廠預估材數')
-            
-            # 在plot_comparison兩個子圖中畫出最大產能橫線
-            if hasattr(self, 'factory1_max_capacity') and self.factory1_max_capacity:
-                ax1.axhline(y=self.factory1_max_capacity, color='b', linestyle=':', label='彰化廠最大產能')
-                ax2.axhline(y=self.factory1_max_capacity, color='b', linestyle=':', label='彰化廠最大產能')
-            if hasattr(self, 'factory2_max_capacity') and self.factory2_max_capacity:
-                ax1.axhline(y=self.factory2_max_capacity, color='r', linestyle=':', label='台南廠最大產能')
-                ax2.axhline(y=self.factory2_max_capacity, color='r', linestyle=':', label='台南廠最大產能')
-            
-            # 添加數據標籤
-            for x, y1, y2, y3, y4 in zip(df['日期區間'], 
-                                        df['彰化廠材數'], 
-                                        df['台南廠材數'],
-                                        df['彰化廠預估材數'],
-                                        df['台南廠預估材數']):
-                ax1.annotate(f'{int(y1):,}', (x, y1), textcoords="offset points", 
-                            xytext=(0,10), ha='center', fontsize=8)
-                ax1.annotate(f'{int(y2):,}', (x, y2), textcoords="offset points", 
-                            xytext=(0,-15), ha='center', fontsize=8)
-                ax1.annotate(f'{int(y3):,}', (x, y3), textcoords="offset points", 
-                            xytext=(0,25), ha='center', fontsize=8)
-                ax1.annotate(f'{int(y4):,}', (x, y4), textcoords="offset points", 
-                            xytext=(0,-30), ha='center', fontsize=8)
-            
-            ax1.set_title('實際材數與預估材數比較', fontsize=14, pad=20)
-            ax1.set_xlabel('日期區間', fontsize=12)
-            ax1.set_ylabel('材數', fontsize=12)
-            ax1.legend(fontsize=10)
-            ax1.grid(True)
-            
-            # 不要再呼叫set_xticks/set_xticklabels，直接用tick_params旋轉
-            ax1.tick_params(axis='x', rotation=45, labelsize=10)
-            
-            # 第二個子圖：合計材數比較
-            ax2.plot(df['日期區間'], df['彰化廠合計材數'], 'b-', marker='o', label='彰化廠合計材數')
-            ax2.plot(df['日期區間'], df['台南廠合計材數'], 'r-', marker='o', label='台南廠合計材數')
+            index = self.get_drilldown()
+            if key is not None:
+                return index.breakdown(column, key)
+            week = WEEKS.ordinal(week) if week is not None else None
+            factory = self.factories.index(factory) if factory is not None else None
+            return index.top(column, week, factory, top, where)
+        except Exception as e:
+            print(f"明細下鑽時發生錯誤：{str(e)}")
+            return None
+
+    def drill_down_analysis(self):
+        """互動選擇維度、週別與工廠，印出前幾名，並可再查看某個值在各週各廠的分布"""
+        def choose(options, text):
+            if not text:
+                return None
+            number = int(text)
+            if not 1 <= number <= len(options):
+                raise ValueError(f"請輸入 1 到 {len(options)}")
+            return number - 1
+        
+        try:
+            index = self.get_drilldown()
+            print("\n=== 明細下鑽 ===")
+            print('，'.join(f"{idx}. {column}" for idx, column in enumerate(DRILLDOWN_COLUMNS, start=1)))
+            column = DRILLDOWN_COLUMNS[choose(DRILLDOWN_COLUMNS, input("請選擇維度（直接按 Enter 為門市代號）: ").strip()) or 0]
+            weeks = [int(week) for week in index.weeks]
+            print('\n'.join(f"{idx}. {WEEKS.label(week)}" for idx, week in enumerate(weeks, start=1)))
+            position = choose(weeks, input("請選擇週別（直接按 Enter 為全部）: ").strip())
+            print('，'.join(f"{idx}. {label}" for idx, label in enumerate(self.factories.labels, start=1)))
+            factory = choose(self.factories.labels, input("請選擇工廠（直接按 Enter 為全部）: ").strip())
+            top = int(input("顯示前幾名（直接按 Enter 為 10）: ").strip() or 10)
+            text = input("篩選條件，例如 門市代號=S001（直接按 Enter 略過）: ").strip()
+            where = parse_drilldown_filter(text) if text else None
             
-            # 添加合計材數標籤
-            for x, y1, y2 in zip(df['日期區間'], df['彰化廠合計材數'], df['台南廠合計材數']):
-                ax2.annotate(f'{int(y1):,}', (x, y1), textcoords="offset points", 
-                            xytext=(0,10), ha='center', fontsize=8)
-                ax2.annotate(f'{int(y2):,}', (x, y2), textcoords="offset points", 
-                            xytext=(0,-15), ha='center', fontsize=8)
+            start = time.perf_counter()
+            result = index.top(column, weeks[position] if position is not None else None, factory, top, where)
+            elapsed = time.perf_counter() - start
+            print_drilldown(result)
+            print(f"查詢時間 {elapsed * 1000:.1f} ms")
+            value = input(f"輸入{column}查看各週各廠的材數（直接按 Enter 略過）: ").strip()
+            if value:
+                print_drilldown(index.breakdown(column, value))
+            return result
+        except ValueError as e:
+            print(f"輸入錯誤：{str(e)}")
+            return None
+        except Exception as e:
+            print(f"明細下鑽時發生錯誤：{str(e)}")
+            return None
+
+    def watch(self, interval=2.0, debounce=5.0, on_update=None):
+        """監看主資料庫與預估訂單資料庫，檔案寫入停止 debounce 秒後在背景增量更新，只重新輸出有變動的週
+        on_update(報表, 變動遮罩) 在每次更新後呼叫；回傳監看器，呼叫 stop() 結束監看"""
+        previous = self.get_report_model() if self.has_factory_data() else None
+        
+        def refresh(changed):
+            nonlocal previous
+            start = time.perf_counter()
+            if self.db_path in changed and not self.refresh_data_from_database():
+                return
+            if self.excel_path in changed:
+                self.load_estimated_orders_from_accdb()
+            model = self.get_report_model()
+            mask, removed = changed_report_weeks(previous, model)
+            previous = model
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] 偵測到資料庫變動，"
+                  f"{int(mask.sum())} 週有變動（{time.perf_counter() - start:.2f} 秒）")
+            if mask.any():
+                print_report_table(render_report_table(model.subset(mask)))
+            if removed:
+                print("已不在報表中的週：" + '、'.join(removed))
+            if on_update is not None:
+                on_update(model, mask)
+        
+        watcher = SourceWatcher([self.db_path, self.excel_path], refresh, interval, debounce)
+        return watcher.start()
+
+    def allocate_estimated_orders(self, max_advance_weeks=0):
+        """依目前比例設定與各廠每週最大材數，建議預估訂單的工廠（與週）分配，回傳 (分配結果, 各週摘要)"""
+        uncapped = self.factories.uncapped_labels()
+        if max_advance_weeks > 0 and uncapped:
+            print(f"{'、'.join(uncapped)}未設定每週最大材數，無法判斷產能是否不足，不提前生產（可用選項7或 --capacity 設定）")
+            max_advance_weeks = 0
+        # 直接使用載入時維護的各週實際材數（門市類別加總），不再重新彙總主資料
+        actual = {week: values.sum(axis=1).tolist() for week, values in self.actual_weeks.items()}
+        return allocate_orders(actual, self.estimated_orders, self.factories, self.get_ratio_plan(),
+                               self.ratio_settings['upper'], self.ratio_settings['lower'], max_advance_weeks)
+
+    def export_allocation(self, output_dir='.', max_advance_weeks=0):
+        """把訂單分配建議匯出成 Excel（調整清單、各週摘要、全部訂單），回傳檔案路徑（失敗時回傳 False）"""
+        try:
+            from openpyxl import Workbook
+            if self.estimated_orders.empty:
+                print("沒有預估訂單可供分配，請先載入數據（選項1）")
+                return False
+            assignments, weeks = self.allocate_estimated_orders(max_advance_weeks)
+            changes = assignments[assignments['是否調整']].drop(columns=['是否調整'])
+            filename = os.path.join(output_dir, f'Order_Allocation_{datetime.now().strftime("%Y%m%d")}.xlsx')
+            workbook = Workbook(write_only=True)
+            write_excel_sheet(workbook, '調整清單', changes)
+            write_excel_sheet(workbook, '各週摘要', weeks)
+            write_excel_sheet(workbook, '全部訂單', assignments)
+            workbook.save(filename)
+            print(f"建議調整 {len(changes)} 筆訂單（{changes['預估材數'].sum():,.0f} 材數）")
+            print(f"訂單分配建議已匯出為: {filename}")
+            return filename
+        except Exception as e:
+            print(f"匯出訂單分配建議時發生錯誤：{str(e)}")
+            return False
+
+    def run_scenarios(self, scenarios, detail=False):
+        """以目前的數據評估多組 (上限, 下限, 比例兩側產能) 情境，不改變目前的設定"""
+        model = self.get_report_model()
+        return evaluate_scenarios(model.frame, scenarios, model.plan, detail)
+
+    def scenario_analysis(self):
+        """互動輸入情境參數並印出各情境的摘要"""
+        try:
+            print("\n=== 情境分析 ===")
+            print("每個參數可輸入多個值（逗號分隔）或區間 起:迄:間距，直接按 Enter 使用目前設定")
+            uppers = parse_grid_values(input(f"比例上限 (目前: {self.ratio_settings['upper']}): "),
+                                       self.ratio_settings['upper'])
+            lowers = parse_grid_values(input(f"比例下限 (目前: {self.ratio_settings['lower']}): "),
+                                       self.ratio_settings['lower'])
+            plan = self.get_ratio_plan()
+            capacity_a, capacity_b = (None if np.isinf(value) else float(value)
+                                      for value in plan.sides(self.factories.capacities()))
+            capacities_a = parse_grid_values(input(f"{plan.a_label}每週最大材數 (目前: {capacity_a or '不限'}): "),
+                                             capacity_a)
+            capacities_b = parse_grid_values(input(f"{plan.b_label}每週最大材數 (目前: {capacity_b or '不限'}): "),
+                                             capacity_b)
+            scenarios = scenario_grid(uppers, lowers, capacities_a, capacities_b)
+            valid = plan.valid_threshold(scenarios['upper']) & plan.valid_threshold(scenarios['lower'])
+            scenarios = scenarios[valid].reset_index(drop=True)
+            if scenarios.empty:
+                print(f"沒有有效的情境（下限值必須小於上限值，且比例必須{plan.threshold_range()}）")
+                return None
+            start = time.perf_counter()
+            summary = self.run_scenarios(scenarios)
+            elapsed = time.perf_counter() - start
+            summary = summary.rename(columns=scenario_labels(plan))
+            print(summary.to_string(float_format=lambda x: f'{x:,.2f}', na_rep='不限'))
+            print(f"共 {len(summary)} 個情境，計算時間 {elapsed * 1000:.1f} ms")
+            if input("是否匯出成 CSV？(y/n): ").strip().lower() == 'y':
+                filename = f'Scenario_Analysis_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+                summary.to_csv(filename, index=False, encoding='utf-8-sig')
+                print(f"情境分析已匯出為: {filename}")
+            return summary
+        except ValueError:
+            print("請輸入有效的數字")
+            return None
+        except Exception as e:
+            print(f"情境分析時發生錯誤：{str(e)}")
+            return None
+
+    @holding_data_lock
+    def get_chart_data(self):
+        """圖表需要的全部數值（可序列化，供內容雜湊與子行程繪圖使用）"""
+        model = self.get_report_model()
+        df = model.frame
+        cubes = self.get_cubes()
+        factories = self.factories
+        
+        def bars(cube):
+            # 長條依 (工廠, 門市類別) 順序排列，與 groups 一致
+            return cube.factory_category().T.tolist()
+        
+        # 比例參考線的基準：pair 為對照工廠合計，total 為全部兩側合計
+        ratio_base = df['對照工廠合計材數'] + (df['比例工廠合計材數'] if model.plan.share else 0)
+        return {
+            'labels': df['日期區間'].tolist(),
+            'series': {column: df[column].astype('float64').tolist() for column in model.numeric_columns},
+            'factories': [{'label': label, 'color': entry['color'], 'capacity': entry['capacity']}
+                          for entry, label in zip(factories.entries, factories.labels)],
+            'groups': [name + category for name in factories.names for category in AggregationCube.CATEGORIES],
+            'ratios': [self.ratio_settings['lower'], self.ratio_settings['upper']],
+            'ratio_base': ratio_base.astype('float64').tolist(),
+            'week_labels': list(cubes['week'].labels),
+            'week_bars': bars(cubes['week']),
+            'month_labels': list(cubes['month'].labels),
+            'month_bars': bars(cubes['month']),
+        }
+
+    @traced('繪製圖表')
+    def plot_comparison(self, output_dir='.', draft=False, split=False, use_cache=True):
+        """繪製比較圖表，回傳圖檔路徑（split 時為四個面板的路徑清單，失敗時回傳 None）
+        draft：降低解析度並省略折線數值標籤；split：四個面板分成四個檔案，以多個行程同時繪製；
+        輸入資料與選項的內容雜湊相同時直接複製快取中的圖檔，不重新繪製"""
+        try:
+            data = self.get_chart_data()
+            dpi = 100 if draft else 300
+            stem = os.path.join(output_dir, f'Factory_Comparison_{datetime.now().strftime("%Y%m%d")}')
+            jobs = [(f'{stem}_{idx + 1}.png', [panel]) for idx, panel in enumerate(CHART_PANELS)] if split \
+                else [(f'{stem}.png', CHART_PANELS)]
             
-            # 添加比例參考線
-            for ratio in [self.ratio_settings['lower'], self.ratio_settings['upper']]:
-                ax2.plot(df['日期區間'], df['台南廠合計材數'] * ratio, '--', 
-                         alpha=0.5, label=f'理想比例 {ratio}')
+            cache = self.snapshot_cache if use_cache else None
+            pending = []
+            for filename, panels in jobs:
+                key = chart_content_hash(data, panels=panels, dpi=dpi, draft=draft)
+                cached = cache.chart_path(key) if cache else None
+                if cached and os.path.exists(cached):
+                    shutil.copyfile(cached, filename)
+                    os.utime(cached)  # 更新使用時間，避免被清除
+                else:
+                    pending.append((filename, panels, cached))
             
-            ax2.set_title('合計材數比較', fontsize=14, pad=20)
-            ax2.set_xlabel('日期區間', fontsize=12)
-            ax2.set_ylabel('材數', fontsize=12)
-            ax2.legend(fontsize=10)
-            ax2.grid(True)
+            # 開始繪製後無法中斷，取消只在這之前生效
+            report_progress(f'繪製 {len(pending)} 張圖表' if pending else '沿用快取圖表')
+            if len(pending) > 1:
+                try:
+                    with ProcessPoolExecutor(max_workers=len(pending)) as pool:
+                        list(pool.map(render_chart, [data] * len(pending), [job[0] for job in pending],
+                                      [job[1] for job in pending], [dpi] * len(pending), [draft] * len(pending)))
+                except Exception as e:
+                    # 無法建立子行程（例如封裝成執行檔）時改為依序繪製
+                    print(f"無法平行繪製，改為依序繪製：{str(e)}")
+                    for filename, panels, _ in pending:
+                        render_chart(data, filename, panels, dpi, draft)
+            else:
+                for filename, panels, _ in pending:
+                    render_chart(data, filename, panels, dpi, draft)
             
-            # 不要再呼叫set_xticks/set_xticklabels，直接用tick_params旋轉
-            ax2.tick_params(axis='x', rotation=45, labelsize=10)
+            if cache and pending:
+                os.makedirs(os.path.dirname(pending[0][2]), exist_ok=True)
+                for filename, _, cached in pending:
+                    shutil.copyfile(filename, cached)
+                cache.prune_charts()
             
-            # ====== ax3：合計門市類別材數（週） ======
-            # 維持原本週區間邏輯
-            all_date_ranges = df['日期區間'].tolist()
-            main_data = getattr(self, 'main_data_df', None)
-            if main_data is None:
-                cursor = self.conn.cursor()
-                query = """
-                SELECT 
-                    ev1020_03 as 出貨日期,
-                    ev1020_88 as 廠別,
-                    ev1020_07 as 材數,
-                    ev1020_13 as 生產性質,
-                    ev1020_20 as 門市,
-                    ev1020_11 as 圖號,
-                    ev1020_12 as 色號,
-                    ev1020_19 as 客戶,
-                    ev1020_06 as 拆單人員,
-                    ev1020_09 as 重量,
-                    ev1020_05 as 門市代號
-                FROM ev1020
-                WHERE ev1020_13 LIKE '%生產%'
-                """
-                cursor.execute(query)
-                columns = [column[0] for column in cursor.description]
-                rows = cursor.fetchall()
-                main_data = pd.DataFrame.from_records(rows, columns=columns)
-                main_data['出貨日期'] = pd.to_datetime(main_data['出貨日期'])
-                self.main_data_df = main_data
-            else:
-                main_data = self.main_data_df
-            main_data['週起始日'] = main_data['出貨日期'].dt.to_period('W').dt.start_time
-            main_data['週結束日'] = main_data['出貨日期'].dt.to_period('W').dt.end_time
-            main_data['日期區間'] = main_data['週起始日'].dt.strftime('%Y/%m/%d') + '-' + main_data['週結束日'].dt.strftime('%Y/%m/%d')
-            def classify_store(code):
-                if isinstance(code, str):
-                    if code.startswith('S'):
-                        return '專案'
-                    elif code.startswith('P'):
-                        return '代工'
-                return '零售'
-            main_data['門市類別'] = main_data['門市代號'].apply(classify_store)
-            main_data['廠別名稱'] = main_data['廠別'].map({'001': '彰化', '002': '台南'})
-            est_orders = pd.DataFrame(self.estimated_orders) if self.estimated_orders else pd.DataFrame()
-            if not est_orders.empty:
-                est_orders['日期'] = pd.to_datetime(est_orders['日期'])
-                est_orders['週起始日'] = est_orders['日期'].dt.to_period('W').dt.start_time
-                est_orders['週結束日'] = est_orders['日期'].dt.to_period('W').dt.end_time
-                est_orders['日期區間'] = est_orders['週起始日'].dt.strftime('%Y/%m/%d') + '-' + est_orders['週結束日'].dt.strftime('%Y/%m/%d')
-                est_orders['門市類別'] = est_orders['門市代號'].apply(classify_store)
-                est_orders['廠別名稱'] = est_orders['工廠'].map({'彰化廠': '彰化', '台南廠': '台南'})
-                est_orders['材數'] = est_orders['預估材數']
-            all_data = pd.concat([main_data[['日期區間','廠別名稱','門市類別','材數']],
-                                  est_orders[['日期區間','廠別名稱','門市類別','材數']] if not est_orders.empty else None],
-                                 ignore_index=True)
-            all_data = all_data[all_data['日期區間'].isin(all_date_ranges)]
-            pivot = all_data.groupby(['日期區間','廠別名稱','門市類別'])['材數'].sum().reset_index()
-            group_keys = [
-                ('彰化','零售'), ('彰化','專案'), ('彰化','代工'),
-                ('台南','零售'), ('台南','專案'), ('台南','代工')
-            ]
-            colors = {
-                ('彰化','零售'): '#008000', # 綠
-                ('彰化','專案'): '#0000FF', # 藍
-                ('彰化','代工'): '#800080', # 紫
-                ('台南','零售'): '#FF0000', # 紅
-                ('台南','專案'): '#FFA500', # 橘
-                ('台南','代工'): '#FFFF00', # 黃
-            }
-            bar_width = 0.12
-            x = np.arange(len(all_date_ranges))
-            offset = np.linspace(-0.3, 0.3, 6)
-            for idx, key in enumerate(group_keys):
-                y = []
-                for dr in all_date_ranges:
-                    val = pivot[(pivot['日期區間']==dr)&(pivot['廠別名稱']==key[0])&(pivot['門市類別']==key[1])]['材數']
-                    y.append(val.values[0] if not val.empty else 0)
-                y = np.array(y)
-                mask = y > 0
-                if mask.any():
-                    ax3.bar(x[mask]+offset[idx], y[mask], width=bar_width, color=colors[key], label=f"{key[0]}{key[1]}")
-                    for xi, yi in zip(x[mask]+offset[idx], y[mask]):
-                        ax3.text(xi, yi, f'{int(yi):,}', ha='center', va='bottom', fontsize=8)
-            ax3.set_xticks(x)
-            ax3.set_xticklabels(all_date_ranges, rotation=45, ha='right', fontsize=10)
-            ax3.set_ylabel('材數', fontsize=12)
-            ax3.set_title('合計門市類別材數', fontsize=14, pad=20)
-            handles, labels = ax3.get_legend_handles_labels()
-            by_label = dict(zip(labels, handles))
-            ax3.legend(by_label.values(), by_label.keys(), fontsize=10)
-            ax3.grid(True, axis='y', linestyle='--', alpha=0.5)
-
-            # ====== ax4：合計門市類別材數（月，固定三個月） ======
-            main_data['月份'] = main_data['出貨日期'].dt.strftime('%Y/%m')
-            if not est_orders.empty:
-                est_orders['月份'] = est_orders['日期'].dt.strftime('%Y/%m')
-            all_data_m = pd.concat([
-                main_data[['月份','廠別名稱','門市類別','材數']],
-                est_orders[['月份','廠別名稱','門市類別','材數']] if not est_orders.empty else None
-            ], ignore_index=True)
-            today = pd.Timestamp.now().replace(day=1)
-            month_list = [(today + pd.DateOffset(months=i)).strftime('%Y/%m') for i in range(3)]
-            pivot_m = all_data_m.groupby(['月份','廠別名稱','門市類別'])['材數'].sum().reset_index()
-            x4 = np.arange(len(month_list))
-            for idx, key in enumerate(group_keys):
-                y = []
-                for m in month_list:
-                    val = pivot_m[(pivot_m['月份']==m)&(pivot_m['廠別名稱']==key[0])&(pivot_m['門市類別']==key[1])]['材數']
-                    y.append(val.values[0] if not val.empty else 0)
-                ax4.bar(x4+offset[idx], y, width=bar_width, color=colors[key], label=f"{key[0]}{key[1]}")
-                for xi, yi in zip(x4+offset[idx], y):
-                    if yi > 0:
-                        ax4.text(xi, yi, f'{int(yi):,}', ha='center', va='bottom', fontsize=8)
-            ax4.set_xticks(x4)
-            ax4.set_xticklabels(month_list, rotation=45, ha='right', fontsize=10)
-            ax4.set_ylabel('材數', fontsize=12)
-            ax4.set_title('合計門市類別材數（月）', fontsize=14, pad=20)
-            handles4, labels4 = ax4.get_legend_handles_labels()
-            by_label4 = dict(zip(labels4, handles4))
-            ax4.legend(by_label4.values(), by_label4.keys(), fontsize=10)
-            ax4.grid(True, axis='y', linestyle='--', alpha=0.5)
-
-            # 調整整體布局
-            plt.tight_layout()
-            plt.savefig(f'Factory_Comparison_{datetime.now().strftime("%Y%m%d")}.png', dpi=300, bbox_inches='tight')
-            plt.close()
-            print(f"圖表已保存為: Factory_Comparison_{datetime.now().strftime('%Y%m%d')}.png")
+            files = [filename for filename, _ in jobs]
+            reused = len(jobs) - len(pending)
+            note = f"（沿用快取 {reused} 張）" if reused else ''
+            print(f"圖表已保存為: {', '.join(files)}{note}")
+            return files if split else files[0]
         except Exception as e:
             print(f"生成圖表時發生錯誤：{str(e)}")
+            return None
 
-    def export_to_excel(self):
-        """將比較報告匯出成 Excel 檔案（數字格式+合計列）"""
+    @traced('匯出Excel')
+    def export_to_excel(self, output_dir='.', details=False):
+        """將比較報告匯出成 Excel 檔案（數字格式+合計列），回傳檔案路徑（失敗時回傳 False）
+        details 為 True 時另外加入每週出貨明細與預估訂單工作表；以 write-only 模式串流寫入，記憶體用量固定"""
         try:
-            if not self.factory1_data or not self.factory2_data:
+            from openpyxl import Workbook
+            if not self.has_factory_data():
                 print("沒有資料可供匯出，請先載入數據（選項1）")
                 return False
                 
-            # 取得報表資料
-            df = self.generate_report()
-
-            # 將數字欄位轉回數字格式
-            numeric_columns = ['彰化廠材數', '台南廠材數', '彰化廠預估材數', '台南廠預估材數', '彰化廠合計材數', '台南廠合計材數', '合計材數差異']
-            for col in numeric_columns:
-                df[col] = df[col].astype(str).str.replace(',', '').replace('-', '0').astype(float)
-
-            # 合計列資料
-            total_row = {}
-            total_row['日期區間'] = '合計'
-            for col in numeric_columns:
-                total_row[col] = df[col].sum()
-            # 比例欄位
-            try:
-                total_ratio = total_row['彰化廠合計材數'] / total_row['台南廠合計材數'] if total_row['台南廠合計材數'] else 0
-                total_row['合計材數比例'] = f"{total_ratio:.2f}"
-            except Exception:
-                total_row['合計材數比例'] = '-'
-            # 其他欄位
-            for col in df.columns:
-                if col not in total_row:
-                    total_row[col] = '' if col not in ['訂單分配建議', '建議分配量'] else '-'
-            # 將合計列加到DataFrame
-            df = pd.concat([df, pd.DataFrame([total_row])], ignore_index=True)
+            # 取得報表資料（數值欄位保持數值，含合計列）
+            df = render_report_excel(self.get_report_model())
 
             # 生成檔案名稱（包含日期）
-            filename = f'Factory_Comparison_{datetime.now().strftime("%Y%m%d")}.xlsx'
+            filename = os.path.join(output_dir, f'Factory_Comparison_{datetime.now().strftime("%Y%m%d")}.xlsx')
 
             # 寫入Excel
-            with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-                df.to_excel(writer, sheet_name='比較報告', index=False)
-                worksheet = writer.sheets['比較報告']
-                # 自動調整欄寬
-                for idx, col in enumerate(df.columns):
-                    max_length = max(df[col].astype(str).apply(len).max(), len(col))
-                    worksheet.column_dimensions[chr(65 + idx)].width = max_length + 2
+            workbook = Workbook(write_only=True)
+            try:
+                write_excel_sheet(workbook, '比較報告', df)
+                if details:
+                    self._write_detail_sheets(workbook)
+            except JobCancelled:
+                # 取消時先關閉各工作表的串流，不留下寫到一半的檔案
+                for worksheet in workbook.worksheets:
+                    if not worksheet.closed:
+                        worksheet.close()
+                raise
+            workbook.save(filename)
             print(f"報表已匯出為: {filename}")
-            return True
+            return filename
         except Exception as e:
             print(f"匯出 Excel 時發生錯誤：{str(e)}")
             return False
 
-def main():
+    def _write_detail_sheets(self, workbook):
+        """每週一張出貨明細工作表（超過 Excel 列數上限時分頁），以及預估訂單工作表"""
+        main_data = self.main_data_df
+        if main_data is not None and not main_data.empty:
+            detail = main_data.copy(deep=False)
+            detail['門市類別'] = pd.Categorical.from_codes(classify_store_codes(detail['門市代號']),
+                                                     AggregationCube.CATEGORIES)
+            # 依出貨日期排序一次，之後每週只取索引區段，不複製整份明細
+            dates = detail['出貨日期'].to_numpy()
+            order = np.argsort(dates, kind='stable')
+            sorted_dates = dates[order]
+            widths = excel_column_widths(detail)
+            for week in sorted(self.date_ranges):
+                start = WEEKS.start(week)
+                lo, hi = np.searchsorted(sorted_dates, [start.to_datetime64(), WEEKS.start(week + 1).to_datetime64()])
+                title = '明細 ' + start.strftime('%m%d') + '-' + WEEKS.end(week).strftime('%m%d')
+                for page, offset in enumerate(range(lo, max(hi, lo + 1), EXCEL_MAX_ROWS)):
+                    rows = detail.take(order[offset:min(offset + EXCEL_MAX_ROWS, hi)])
+                    write_excel_sheet(workbook, title if page == 0 else f'{title} ({page + 1})', rows, widths)
+        orders = self.estimated_orders
+        if not orders.empty:
+            orders = orders.sort_values(['工廠', '日期'], kind='stable')
+            write_excel_sheet(workbook, '預估訂單', orders)
+
+    @traced('匯出CSV')
+    def export_to_csv(self, output_dir='.'):
+        """將比較報告（含合計列）匯出成 CSV，回傳檔案路徑（失敗時回傳 False）"""
+        try:
+            filename = os.path.join(output_dir, f'Factory_Comparison_{datetime.now().strftime("%Y%m%d")}.csv')
+            render_report_excel(self.get_report_model()).to_csv(filename, index=False, encoding='utf-8-sig')
+            print(f"報表已匯出為: {filename}")
+            return filename
+        except Exception as e:
+            print(f"匯出 CSV 時發生錯誤：{str(e)}")
+            return False
+
+# 合成資料的門市代號池：S 開頭為專案、P 開頭為代工、其餘為零售
+SYNTHETIC_STORE_PREFIXES = [('S', 60), ('P', 40), ('A', 150), ('B', 120), ('C', 80), ('K', 50)]
+BENCHMARK_STAGES = ['讀取主資料', '讀取預估訂單', '產生報表', '繪製圖表', '匯出Excel']
+
+
+def parse_row_count(text):
+    """筆數參數，可用 k/M 結尾（例如 10k、1M）"""
+    text = str(text).strip()
+    scale = {'k': 1000, 'm': 1000000}.get(text[-1:].lower(), 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+
+def generate_synthetic_data(db_path, rows, seed=0, estimated_path=None, estimated_rows=None, batch_size=200000,
+                            factories=None):
+    """以固定亂數種子產生 ev1020 合成資料到本機 SQLite 替代資料庫
+    廠別依工廠登錄（第一廠約 55%，其餘平分）、門市代號 S/P/零售、出貨日期集中在查詢範圍內並保留部分歷史資料；
+    有指定 estimated_path 時一併產生各廠的預估訂單查詢表"""
+    factories = factories or FactoryRegistry()
+    factory_codes = np.array(factories.codes)
+    factory_share = np.cumsum([0.55] + [0.45 / max(len(factories) - 1, 1)] * (len(factories) - 1))
+    rng = np.random.default_rng(seed)
+    today = np.datetime64(get_week_start().date(), 'D')
+    codes = np.array([f"{prefix}{i:03d}" for prefix, count in SYNTHETIC_STORE_PREFIXES for i in range(1, count + 1)])
+    # 門市出貨量接近冪次分佈：少數大門市佔多數材數
+    weights = 1.0 / np.arange(1, len(codes) + 1) ** 0.8
+    weights = rng.permutation(weights / weights.sum())
+    
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        create_ev1020_table(conn)
+        columns = list(EV1020_COLUMNS.values())
+        insert = f"INSERT INTO ev1020 ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        for offset in range(0, rows, batch_size):
+            n = min(batch_size, rows - offset)
+            # 七成落在本月初到往後 12 週，三成為過去 120 天的歷史資料；週日出貨較少
+            days = np.where(rng.random(n) < 0.7, rng.integers(-31, 84, n), rng.integers(-120, -31, n))
+            dates = today + days.astype('timedelta64[D]')
+            sunday = (dates.astype('datetime64[D]').view('int64') + 4) % 7 == 6
+            dates = np.where(sunday & (rng.random(n) < 0.7), dates - np.timedelta64(1, 'D'), dates)
+            store = rng.choice(len(codes), n, p=weights)
+            amount = np.round(rng.lognormal(1.2, 0.9, n), 2)
+            batch = {
+                '出貨日期': np.char.add(np.datetime_as_string(dates, unit='D'), ' 00:00:00'),
+                '廠別': factory_codes[np.minimum(np.searchsorted(factory_share, rng.random(n), side='right'),
+                                                 len(factory_codes) - 1)],
+                '材數': amount,
+                '生產性質': rng.choice(['生產', '生產急件', '樣品'], n, p=[0.85, 0.05, 0.10]),
+                '門市': np.char.add('門市', codes[store]),
+                '圖號': np.char.add('D', rng.integers(10000, 99999, n).astype(str)),
+                '色號': np.char.add('C', rng.integers(1, 60, n).astype(str)),
+                '客戶': np.char.add('客戶', (store % 97).astype(str)),
+                '拆單人員': rng.choice(['王', '林', '陳', '黃', '張'], n),
+                '重量': np.round(amount * rng.uniform(2.0, 3.0, n), 2),
+                '門市代號': codes[store],
+            }
+            conn.executemany(insert, zip(*(batch[alias].tolist() for alias in EV1020_COLUMNS)))
+        conn.commit()
+    finally:
+        conn.close()
+    
+    if estimated_path:
+        estimated_rows = estimated_rows if estimated_rows is not None else max(1000, rows // 100)
+        if os.path.exists(estimated_path):
+            os.remove(estimated_path)
+        conn = sqlite3.connect(estimated_path)
+        try:
+            for table, _ in factories.tables:
+                conn.execute(f"CREATE TABLE [{table}] (預計出貨日 TIMESTAMP, 門市 TEXT, 門市代號 TEXT, 預估材數 REAL, 備註 TEXT)")
+                n = estimated_rows // len(factories.tables)
+                dates = today + rng.integers(0, 84, n).astype('timedelta64[D]')
+                store = rng.choice(len(codes), n, p=weights)
+                notes = np.where(rng.random(n) < 0.2, '急件', None)
+                conn.executemany(f"INSERT INTO [{table}] VALUES (?, ?, ?, ?, ?)", zip(
+                    np.char.add(np.datetime_as_string(dates, unit='D'), ' 00:00:00').tolist(),
+                    np.char.add('門市', codes[store]).tolist(), codes[store].tolist(),
+                    np.round(rng.lognormal(2.0, 0.8, n), 1).tolist(), notes.tolist()))
+            conn.commit()
+        finally:
+            conn.close()
+    return True
+
+
+def run_benchmark(sizes, seed=0, work_dir='benchmark', baseline_path=None, save_baseline=False,
+                  tolerance=0.2, stages=None):
+    """以合成資料量測各階段耗時、每秒筆數與行程尖峰記憶體，並與基準檔比較
+    只量測報表、圖表或 Excel 時，先不計時載入資料；每秒筆數只計算讀取階段（實際讀到的筆數），其他階段留空；
+    尖峰記憶體是到該階段結束為止的行程最高值，每個筆數最好分開執行才看得出差異；
+    合成資料庫依筆數與種子重複使用；回傳是否有階段比基準慢超過 tolerance"""
+    import io
+    from contextlib import redirect_stdout
+    
+    stages = stages or BENCHMARK_STAGES
+    os.makedirs(work_dir, exist_ok=True)
+    baseline = {}
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f).get('results', {})
+    
+    results = {}
+    regressed = False
+    print(f"{'筆數':>10}  {'階段':<8}{'秒數':>9}{'每秒筆數':>13}{'尖峰MB':>9}{'基準秒數':>10}{'變化':>9}")
+    for rows in sizes:
+        db_path = os.path.join(work_dir, f'bench_{rows}_{seed}.db')
+        estimated_path = os.path.join(work_dir, f'bench_{rows}_{seed}_estimated.db')
+        if not (os.path.exists(db_path) and os.path.exists(estimated_path)):
+            start = time.perf_counter()
+            generate_synthetic_data(db_path, rows, seed, estimated_path, factories=FactoryRegistry.load())
+            print(f"{rows:>10}  產生合成資料 {time.perf_counter() - start:.2f} 秒")
+        
+        comparison = FactoryComparison()
+        comparison.db_path = db_path
+        comparison.excel_path = estimated_path
+        comparison.snapshot_cache = None  # 量測實際讀取，不使用本機快照
+        comparison.state_file = os.path.join(work_dir, 'bench_state.json')
+        comparison.ev1020_state = {}
+        actions = {
+            '讀取主資料': lambda: comparison.load_data_from_database(use_cache=False),
+            '讀取預估訂單': lambda: comparison.load_estimated_orders_from_accdb(use_cache=False),
+            '產生報表': lambda: not comparison.generate_report().empty,
+            '繪製圖表': lambda: comparison.plot_comparison(work_dir, use_cache=False),
+            '匯出Excel': lambda: comparison.export_to_excel(work_dir),
+        }
+        # 讀取階段實際處理的筆數（主資料只含查詢範圍內的列）
+        stage_rows = {
+            '讀取主資料': lambda: len(comparison.main_data_df),
+            '讀取預估訂單': lambda: len(comparison.estimated_orders),
+        }
+        # 報表、圖表與 Excel 需要已載入的資料，沒有選讀取階段時先不計時載入
+        loaders = [stage for stage in BENCHMARK_STAGES[:2] if stage not in stages] \
+            if any(stage in stages for stage in BENCHMARK_STAGES[2:]) else []
+        results[str(rows)] = {}
+        try:
+            with redirect_stdout(io.StringIO()):
+                connected = comparison.connect_to_database(interactive=False)
+            if not connected:
+                print(f"無法連接合成資料庫：{db_path}")
+                return True
+            for stage in loaders:
+                output = io.StringIO()
+                with redirect_stdout(output):
+                    ok = actions[stage]()
+                if not ok:
+                    print(f"{rows:>10}  {stage}（不計時）失敗：{output.getvalue().strip()}")
+                    return True
+            for stage in stages:
+                output = io.StringIO()
+                start = time.perf_counter()
+                with redirect_stdout(output):
+                    ok = actions[stage]()
+                seconds = time.perf_counter() - start
+                peak = peak_memory_mb()
+                if not ok:
+                    print(f"{rows:>10}  {stage} 失敗：{output.getvalue().strip()}")
+                    regressed = True
+                    continue
+                handled = stage_rows[stage]() if stage in stage_rows else None
+                results[str(rows)][stage] = {'seconds': round(seconds, 4), 'peak_mb': round(peak, 1), 'rows': handled}
+                
+                base = baseline.get(str(rows), {}).get(stage)
+                change = ''
+                if base and base['seconds'] > 0:
+                    ratio = seconds / base['seconds'] - 1
+                    change = f"{ratio:+.0%}"
+                    if ratio > tolerance:
+                        change += ' 變慢'
+                        regressed = True
+                base_text = f"{base['seconds']:.3f}" if base else '-'
+                rate = f"{handled / seconds:,.0f}" if handled is not None and seconds > 0 else '-'
+                print(f"{rows:>10}  {stage:<8}{seconds:>9.3f}{rate:>13}{peak:>9.1f}{base_text:>10}{change:>9}")
+        finally:
+            comparison.close()
+    
+    if save_baseline and baseline_path:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump({'created_at': datetime.now().isoformat(timespec='seconds'), 'seed': seed,
+                       'python': sys.version.split()[0], 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"基準已保存為: {baseline_path}")
+    elif regressed:
+        print(f"有階段比基準慢超過 {tolerance:.0%}")
+    return regressed
+
+
+def print_report_table(report):
+    """在主控台印出比較報告（日期區間只顯示月/日，欄位靠左對齊）"""
+    if report.empty:
+        print(report)
+        return
+    # 日期區間只顯示mm/dd-mm/dd（標籤為固定格式 YYYY/MM/DD-YYYY/MM/DD，直接取子字串）
+    report = report.copy()
+    if '日期區間' in report.columns:
+        labels = report['日期區間'].astype(str)
+        report['日期區間'] = labels.where(labels.str.len() != 21, labels.str[5:10] + '-' + labels.str[16:21])
+    # 欄寬根據最大內容自動決定，所有欄名與資料都靠左，欄與欄之間4個空格
+    col_widths = [max(len(str(x)) for x in report[col].astype(str)) for col in report.columns]
+    col_widths = [max(w, len(col)) for w, col in zip(col_widths, report.columns)]
+    # 印欄位名稱（靠左）
+    header = (' ' * 4).join([str(col).ljust(width) for col, width in zip(report.columns, col_widths)])
+    print(header)
+    # 印每一列（靠左）
+    for _, row in report.iterrows():
+        line = (' ' * 4).join([str(row[col]).ljust(width) for col, width in zip(report.columns, col_widths)])
+        print(line)
+
+
+def parse_drilldown_filter(text):
+    """「維度=值」格式的篩選條件，回傳 (維度, 值)"""
+    column, separator, value = text.partition('=')
+    column = column.strip()
+    if not separator or column not in DRILLDOWN_COLUMNS:
+        raise ValueError(f"篩選條件格式為 維度=值，維度為 {'、'.join(DRILLDOWN_COLUMNS)}")
+    return column, value.strip()
+
+
+def print_drilldown(frame):
+    """印出下鑽結果：材數加千分位、占比為百分比"""
+    display = frame.copy()
+    for col in frame.columns:
+        if col == '占比':
+            display[col] = frame[col].map('{:.1%}'.format)
+        elif col == '筆數':
+            display[col] = frame[col].map('{:,}'.format)
+        elif pd.api.types.is_float_dtype(frame[col]):
+            display[col] = frame[col].map('{:,.0f}'.format)
+    print_report_table(display)
+
+
+def build_arg_parser():
+    """命令列參數；不帶子命令時進入互動選單"""
+    import argparse
+    parser = argparse.ArgumentParser(description='工廠材數比較系統')
+    parser.add_argument('--trace', action='store_true',
+                        help='記錄各階段耗時與記憶體到 JSON lines 檔（也可設定環境變數 F2_TRACE）')
+    parser.add_argument('--trace-file', default=StageTracer.DEFAULT_PATH, help='追蹤檔路徑')
+    subparsers = parser.add_subparsers(dest='command')
+    batch = subparsers.add_parser('batch', help='非互動批次模式：載入一次並輸出報表、CSV、圖表與 Excel')
+    batch.add_argument('--db', help='主資料庫路徑（預設使用 database_config.json）')
+    batch.add_argument('--estimated', help='預估訂單資料庫路徑（預設使用 excel_config.json）')
+    batch.add_argument('--upper', type=float, help='比例上限（只影響本次執行）')
+    batch.add_argument('--lower', type=float, help='比例下限（只影響本次執行）')
+    batch.add_argument('--capacity1', type=int, help='第一個登錄工廠（預設彰化廠）每週最大材數（只影響本次執行）')
+    batch.add_argument('--capacity2', type=int, help='第二個登錄工廠（預設台南廠）每週最大材數（只影響本次執行）')
+    batch.add_argument('--capacity', action='append', default=[], metavar='廠別=材數',
+                       help='指定工廠每週最大材數，例如 003=50000（可重複，只影響本次執行）')
+    batch.add_argument('--ratio-mode', choices=['pair', 'total'],
+                       help='比例模式：pair 為兩廠相比，total 為某廠占全部工廠的比例（只影響本次執行）')
+    batch.add_argument('--pair', help='比例兩側的廠別，以逗號分隔，例如 001,003（total 模式只用第一個）')
+    batch.add_argument('--output-dir', default='.', help='輸出資料夾（預設為目前資料夾）')
+    batch.add_argument('--no-cache', action='store_true', help='略過本機快照，直接讀取資料庫')
+    batch.add_argument('--skip-chart', action='store_true', help='不產生圖表')
+    batch.add_argument('--skip-excel', action='store_true', help='不產生 Excel')
+    batch.add_argument('--draft', action='store_true', help='圖表使用草稿模式（較低解析度、省略折線標籤）')
+    batch.add_argument('--split-panels', action='store_true', help='圖表四個面板分別輸出，並以多個行程同時繪製')
+    batch.add_argument('--details', action='store_true', help='Excel 另外加入每週出貨明細與預估訂單工作表')
+    batch.add_argument('--allocation', action='store_true', help='另外匯出預估訂單分配建議（依產能與比例）')
+    batch.add_argument('--advance-weeks', type=int, default=0, help='分配建議中產能不足時可提前生產的週數')
+    generate = subparsers.add_parser('generate', help='產生 ev1020 與預估訂單合成資料（SQLite）')
+    generate.add_argument('--db', required=True, help='輸出的 ev1020 SQLite 檔案')
+    generate.add_argument('--estimated', help='輸出的預估訂單 SQLite 檔案')
+    generate.add_argument('--rows', type=parse_row_count, default=100000, help='ev1020 筆數（可用 10k、1M）')
+    generate.add_argument('--estimated-rows', type=parse_row_count, help='預估訂單筆數（預設為 ev1020 的 1%%）')
+    generate.add_argument('--seed', type=int, default=0, help='亂數種子')
+    bench = subparsers.add_parser('bench', help='以合成資料量測載入、報表、圖表與 Excel 的效能')
+    bench.add_argument('--sizes', type=parse_row_count, nargs='+', default=[10000, 100000, 1000000],
+                       help='測試筆數（可用 10k、1M、10M）')
+    bench.add_argument('--seed', type=int, default=0, help='亂數種子')
+    bench.add_argument('--work-dir', default='benchmark', help='合成資料與輸出檔案的資料夾')
+    bench.add_argument('--baseline', default='benchmark_baseline.json', help='基準檔')
+    bench.add_argument('--save-baseline', action='store_true', help='把這次結果存成基準')
+    bench.add_argument('--tolerance', type=float, default=0.2, help='比基準慢多少比例視為退步（預設 0.2）')
+    bench.add_argument('--stages', nargs='+', choices=BENCHMARK_STAGES, help='只量測指定階段（依序執行）')
+    drill = subparsers.add_parser('drill', help='明細下鑽：某週某廠材數最多的門市、客戶、圖號、色號等（載入一次，不另外查詢）')
+    drill.add_argument('--db', help='主資料庫路徑（預設使用 database_config.json）')
+    drill.add_argument('--by', choices=DRILLDOWN_COLUMNS, default='門市代號', help='下鑽維度（預設門市代號）')
+    drill.add_argument('--week', help='週內任一天，例如 2026/10/12（預設全部週）')
+    drill.add_argument('--factory', help='廠別代碼或名稱，例如 001 或 彰化（預設全部工廠）')
+    drill.add_argument('--top', type=int, default=10, help='顯示前幾名（預設 10）')
+    drill.add_argument('--where', help='篩選條件，例如 門市代號=S001')
+    drill.add_argument('--key', help='改為列出此值在各週各廠的材數，例如 --by 門市代號 --key S001')
+    drill.add_argument('--output', help='另存成 CSV 檔')
+    drill.add_argument('--no-cache', action='store_true', help='略過本機快照，直接讀取資料庫')
+    watch = subparsers.add_parser('watch', help='監看模式：資料庫變動時自動增量更新，並只重新輸出有變動的週')
+    watch.add_argument('--db', help='主資料庫路徑（預設使用 database_config.json）')
+    watch.add_argument('--estimated', help='預估訂單資料庫路徑（預設使用 database_config.json）')
+    watch.add_argument('--interval', type=float, default=2.0, help='檢查檔案變動的間隔秒數（預設 2）')
+    watch.add_argument('--debounce', type=float, default=5.0, help='檔案停止寫入多少秒後才更新（預設 5）')
+    watch.add_argument('--duration', type=float, help='監看多少秒後結束（預設直到按 Ctrl+C）')
+    watch.add_argument('--csv', action='store_true', help='每次更新後重新匯出 CSV')
+    watch.add_argument('--output-dir', default='.', help='CSV 輸出資料夾（預設為目前資料夾）')
+    watch.add_argument('--no-cache', action='store_true', help='第一次載入略過本機快照，直接讀取資料庫')
+    serve = subparsers.add_parser('serve', help='服務模式：載入一次，以本機 HTTP/JSON 提供報表、門市類別彙總與圖表')
+    serve.add_argument('--db', help='主資料庫路徑（預設使用 database_config.json）')
+    serve.add_argument('--estimated', help='預估訂單資料庫路徑（預設使用 database_config.json）')
+    serve.add_argument('--host', default='127.0.0.1', help='監聽位址（預設 127.0.0.1，只接受本機連線）')
+    serve.add_argument('--port', type=int, default=8765, help='連接埠（預設 8765，0 為自動選擇）')
+    serve.add_argument('--watch', action='store_true', help='資料庫變動時自動增量更新')
+    serve.add_argument('--interval', type=float, default=2.0, help='檢查檔案變動的間隔秒數（預設 2）')
+    serve.add_argument('--debounce', type=float, default=5.0, help='檔案停止寫入多少秒後才更新（預設 5）')
+    serve.add_argument('--duration', type=float, help='服務多少秒後結束（預設直到按 Ctrl+C）')
+    serve.add_argument('--no-cache', action='store_true', help='第一次載入略過本機快照，直接讀取資料庫')
+    startup = subparsers.add_parser('startup', help='量測啟動時間（匯入、讀取設定、連接資料庫到顯示選單）')
+    startup.add_argument('--budget', type=float, help='啟動時間上限（秒），超過時以代碼 1 結束')
+    return parser
+
+
+def run_batch(args):
+    """批次模式：載入一次、建立一次報表，依序輸出主控台報表、CSV、圖表與 Excel
+    結束代碼：0 全部成功，1 無法連線或載入主資料，2 部分輸出或預估訂單失敗，3 參數錯誤"""
+    comparison = FactoryComparison()
+    if args.db:
+        comparison.db_path = args.db
+    if args.estimated:
+        comparison.excel_path = args.estimated
+    # 覆寫的設定只保存在記憶體，不寫回設定檔
+    upper = args.upper if args.upper is not None else comparison.ratio_settings['upper']
+    lower = args.lower if args.lower is not None else comparison.ratio_settings['lower']
+    comparison.ratio_settings = dict(comparison.ratio_settings, upper=upper, lower=lower)
+    if args.ratio_mode:
+        comparison.ratio_settings['mode'] = args.ratio_mode
+    if args.pair:
+        comparison.ratio_settings['pair'] = [code.strip() for code in args.pair.split(',')]
+    try:
+        capacities = [(idx, value) for idx, value in enumerate([args.capacity1, args.capacity2]) if value is not None]
+        for item in args.capacity:
+            key, _, value = item.partition('=')
+            capacities.append((comparison.factories.index(key.strip()), int(value)))
+        for idx, value in capacities:
+            comparison.factories.set_capacity(comparison.factories.codes[idx], value)
+        # 一併檢查上下限（total 模式為占比，必須介於 0 與 1 之間）
+        comparison.get_ratio_plan()
+    except (ValueError, IndexError) as e:
+        print(f"工廠或比例設定錯誤：{str(e)}")
+        return 3
+    try:
+        os.makedirs(args.output_dir, exist_ok=True)
+    except Exception as e:
+        print(f"無法建立輸出資料夾：{str(e)}")
+        return 3
+    
+    if not comparison.connect_to_database(interactive=False):
+        return 1
+    try:
+        results = comparison.load_all(use_cache=not args.no_cache)
+        if not results['ev1020']['ok'] or not comparison.date_ranges:
+            print("沒有可用的數據，批次模式結束")
+            return 1
+        exit_code = 0 if all(result['ok'] for result in results.values()) else 2
+        
+        print("\n=== 比較報告 ===")
+        print_report_table(comparison.generate_report())
+        outputs = [comparison.export_to_csv(args.output_dir)]
+        if not args.skip_chart:
+            outputs.append(comparison.plot_comparison(args.output_dir, draft=args.draft, split=args.split_panels))
+        if not args.skip_excel:
+            outputs.append(comparison.export_to_excel(args.output_dir, details=args.details))
+        if args.allocation:
+            outputs.append(comparison.export_allocation(args.output_dir, args.advance_weeks))
+        if not all(outputs):
+            exit_code = 2
+        return exit_code
+    finally:
+        comparison.close()
+
+
+def run_drill(args):
+    """下鑽模式：只載入主資料，印出下鑽結果（可另存 CSV）
+    結束代碼：0 成功，1 無法連線或載入主資料，3 參數錯誤"""
+    comparison = FactoryComparison()
+    if args.db:
+        comparison.db_path = args.db
+    try:
+        where = parse_drilldown_filter(args.where) if args.where else None
+        if args.week is not None:
+            pd.Timestamp(args.week)
+    except ValueError as e:
+        print(f"參數錯誤：{str(e)}")
+        return 3
+    
+    if not comparison.connect_to_database(interactive=False):
+        return 1
+    try:
+        loaded = comparison.load_data_from_database(use_cache=False) if args.no_cache \
+            else comparison.refresh_data_from_database()
+        if not loaded or comparison.main_data_df is None:
+            return 1
+        comparison.get_drilldown()
+        start = time.perf_counter()
+        result = comparison.drill_down(args.by, args.week, args.factory, args.top, where, args.key)
+        elapsed = time.perf_counter() - start
+        if result is None:
+            return 3
+        print_drilldown(result)
+        print(f"查詢時間 {elapsed * 1000:.1f} ms")
+        if args.output:
+            result.to_csv(args.output, index=False, encoding='utf-8-sig')
+            print(f"下鑽結果已匯出為: {args.output}")
+        return 0
+    finally:
+        comparison.close()
+
+
+def run_watch(args):
+    """監看模式：載入一次並輸出完整報表，之後只在資料庫變動時輸出有變動的週
+    結束代碼：0 正常結束，1 無法連線或載入主資料，3 參數錯誤"""
+    if args.interval <= 0 or args.debounce < 0:
+        print("參數錯誤：檢查間隔必須大於0，等待秒數不可小於0")
+        return 3
+    comparison = FactoryComparison()
+    if args.db:
+        comparison.db_path = args.db
+    if args.estimated:
+        comparison.excel_path = args.estimated
+    if not comparison.connect_to_database(interactive=False):
+        return 1
+    watcher = None
+    try:
+        results = comparison.load_all(use_cache=not args.no_cache)
+        if not results['ev1020']['ok'] or comparison.main_data_df is None:
+            return 1
+        print("\n=== 比較報告 ===")
+        print_report_table(comparison.generate_report())
+        on_update = (lambda model, mask: comparison.export_to_csv(args.output_dir)) if args.csv else None
+        watcher = comparison.watch(args.interval, args.debounce, on_update)
+        print(f"\n監看中（每 {args.interval:g} 秒檢查，停止寫入 {args.debounce:g} 秒後更新），按 Ctrl+C 結束")
+        deadline = time.monotonic() + args.duration if args.duration is not None else None
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                time.sleep(0.2)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    finally:
+        if watcher is not None:
+            watcher.stop()
+            print(f"已結束監看，共自動更新 {watcher.updates} 次")
+        comparison.close()
+
+
+JSON_CONTENT_TYPE = 'application/json; charset=utf-8'
+
+
+def json_body(payload):
+    return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+
+def frame_records(frame):
+    """DataFrame 轉成可序列化的列清單（空值為 null）"""
+    return json.loads(frame.to_json(orient='records', force_ascii=False))
+
+
+class ReportService:
+    """本機報表服務：一個行程載入一次資料，多位使用者共用同一份報表、門市類別彙總與圖表
+    回應依 (資料版本, 比例設定) 快取，同一版本只產生一次；ETag 為內容雜湊，內容沒變時用戶端可收到 304"""
+
+    def __init__(self, comparison, chart_dir):
+        self.comparison = comparison
+        self.chart_dir = chart_dir
+        self.lock = threading.RLock()  # 資料更新與產生回應互斥，FactoryComparison 的快取不是執行緒安全的
+        self._responses = {}
+        # 路徑: (產生內容的方法, 會影響內容的查詢參數)
+        self.routes = {
+            '/status': (self.status, ()),
+            '/report': (self.report, ()),
+            '/categories': (self.categories, ('period',)),
+            '/chart.png': (self.chart, ('draft',)),
+        }
+
+    def version(self):
+        return self.comparison.data_version, json.dumps(self.comparison.ratio_settings, sort_keys=True)
+
+    def get(self, path, query):
+        """回傳 (內容類型, 內容, ETag)；path 必須在 routes 中"""
+        handler, params = self.routes[path]
+        args = {name: query.get(name) for name in params}
+        key = (path,) + tuple(args.values())
+        with self.lock:
+            version = self.version()
+            cached = self._responses.get(key)
+            if cached is None or cached[0] != version:
+                content_type, body = handler(**args)
+                cached = (version, content_type, body, f'"{hashlib.sha1(body).hexdigest()[:20]}"')
+                self._responses[key] = cached
+            return cached[1:]
+
+    def refresh(self, changed=None):
+        """重新讀取有變動的來源（changed 為 None 時兩個來源都檢查），回傳目前狀態"""
+        comparison = self.comparison
+        with self.lock:
+            if changed is None or comparison.db_path in changed:
+                comparison.refresh_data_from_database()
+            if changed is None or comparison.excel_path in changed:
+                comparison.refresh_estimated_orders()
+            return self.status()
+
+    def status(self):
+        comparison = self.comparison
+        main_data = comparison.main_data_df
+        return JSON_CONTENT_TYPE, json_body({
+            'db_path': comparison.db_path,
+            'estimated_path': comparison.excel_path,
+            'data_version': comparison.data_version,
+            'rows': 0 if main_data is None else len(main_data),
+            'estimated_rows': len(comparison.estimated_orders),
+            'factories': comparison.factories.labels,
+            'ratio_settings': comparison.ratio_settings,
+        })
+
+    def report(self):
+        model = self.comparison.get_report_model()
+        frame = render_report_excel(model)
+        return JSON_CONTENT_TYPE, json_body({
+            'ratio': model.plan.describe(),
+            'columns': list(frame.columns),
+            'rows': frame_records(frame),
+        })
+
+    def categories(self, period=None):
+        """各期間各廠的門市類別合計材數（實際 + 預估），period 為 week（預設）或 month"""
+        period = period or 'week'
+        cubes = self.comparison.get_cubes()
+        if period not in cubes:
+            raise ValueError("period 必須是 week 或 month")
+        cube = cubes[period]
+        labels = self.comparison.factories.labels
+        values = cube.values.sum(axis=3).reshape(-1, len(AggregationCube.CATEGORIES))
+        frame = pd.DataFrame(values.round(2), columns=AggregationCube.CATEGORIES)
+        frame.insert(0, '期間', np.repeat(cube.labels, len(labels)))
+        frame.insert(1, '工廠', np.tile(labels, len(cube.labels)))
+        frame['合計'] = frame[AggregationCube.CATEGORIES].sum(axis=1)
+        return JSON_CONTENT_TYPE, json_body({'period': period, 'columns': list(frame.columns),
+                                             'rows': frame_records(frame)})
+
+    def chart(self, draft=None):
+        """比較圖表 PNG；draft=1 為草稿模式"""
+        filename = self.comparison.plot_comparison(output_dir=self.chart_dir, draft=draft == '1')
+        if not filename:
+            raise RuntimeError("無法產生圖表")
+        with open(filename, 'rb') as f:
+            return 'image/png', f.read()
+
+
+def etag_matches(header, etag):
+    """If-None-Match 是否包含此 ETag（含 * 與弱比對 W/）"""
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+def create_report_server(service, host='127.0.0.1', port=8765):
+    """建立報表服務的 HTTP 伺服器（每個請求一個執行緒），呼叫 serve_forever() 開始服務
+    GET /status、/report、/categories?period=week|month、/chart.png?draft=1；POST /refresh 立即檢查資料來源"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit, parse_qs
+
+    class ReportRequestHandler(BaseHTTPRequestHandler):
+        def send_body(self, status, content_type=None, body=b'', etag=None):
+            self.send_response(status)
+            if etag:
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+            if status != 304:
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body)
+
+        def send_error_json(self, status, message):
+            self.send_body(status, JSON_CONTENT_TYPE, json_body({'error': message}))
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path not in service.routes:
+                self.send_error_json(404, f"找不到路徑：{url.path}")
+                return
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            try:
+                content_type, body, etag = service.get(url.path, query)
+            except ValueError as e:
+                self.send_error_json(400, str(e))
+                return
+            except Exception as e:
+                print(f"產生 {url.path} 時發生錯誤：{str(e)}")
+                self.send_error_json(500, str(e))
+                return
+            if etag_matches(self.headers.get('If-None-Match', ''), etag):
+                self.send_body(304, etag=etag)
+            else:
+                self.send_body(200, content_type, body, etag)
+
+        def do_POST(self):
+            if urlsplit(self.path).path != '/refresh':
+                self.send_error_json(404, f"找不到路徑：{self.path}")
+                return
+            try:
+                self.send_body(200, *service.refresh())
+            except Exception as e:
+                print(f"更新資料時發生錯誤：{str(e)}")
+                self.send_error_json(500, str(e))
+
+        def log_message(self, format, *args):
+            print(f"[{self.log_date_time_string()}] {self.address_string()} {format % args}")
+
+    return ThreadingHTTPServer((host, port), ReportRequestHandler)
+
+
+def run_serve(args):
+    """服務模式：載入一次，之後以本機 HTTP/JSON 提供報表給其他使用者；--watch 時資料庫變動會自動更新
+    結束代碼：0 正常結束，1 無法連線、載入主資料或啟動服務，3 參數錯誤"""
+    import tempfile
+    if args.watch and (args.interval <= 0 or args.debounce < 0):
+        print("參數錯誤：檢查間隔必須大於0，等待秒數不可小於0")
+        return 3
+    comparison = FactoryComparison()
+    if args.db:
+        comparison.db_path = args.db
+    if args.estimated:
+        comparison.excel_path = args.estimated
+    if not comparison.connect_to_database(interactive=False):
+        return 1
+    watcher = server = None
+    chart_dir = tempfile.mkdtemp(prefix='factory_report_')
+    try:
+        results = comparison.load_all(use_cache=not args.no_cache)
+        if not results['ev1020']['ok'] or comparison.main_data_df is None:
+            return 1
+        service = ReportService(comparison, chart_dir)
+        try:
+            server = create_report_server(service, args.host, args.port)
+        except OSError as e:
+            print(f"無法啟動服務：{str(e)}")
+            return 1
+        if args.watch:
+            watcher = SourceWatcher([comparison.db_path, comparison.excel_path], service.refresh,
+                                    args.interval, args.debounce).start()
+        if args.duration is not None:
+            timer = threading.Timer(args.duration, server.shutdown)
+            timer.daemon = True
+            timer.start()
+        host, port = server.server_address[:2]
+        print(f"報表服務已啟動：http://{host}:{port}/report，按 Ctrl+C 結束")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        if server is not None:
+            server.server_close()
+        comparison.close()
+        shutil.rmtree(chart_dir, ignore_errors=True)
+
+
+def print_menu():
+    print("\n=== 工廠材數比較系統 ===")
+    print("1. 載入資料庫數據（含預估訂單數據）")
+    print("2. 查看比較報告")
+    print("3. 生成比較圖表")
+    print("4. 匯出報表至 Excel")
+    print("5. 查看預估訂單數據")
+    print("6. 設定比例範圍")
+    print("7. 設定每週最大材數")
+    print("8. 更改預估訂單數據路徑")
+    print("9. 更改資料庫位置")
+    print("10. 退出")
+    print("11. 強制重新載入（刪除本機快照）")
+    print("12. 建立本機 SQLite 鏡像")
+    print("13. 情境分析（比例與產能）")
+    print("14. 預估訂單分配建議（依產能與比例）")
+    print("15. 明細下鑽（門市、客戶、圖號、色號）")
+    print("16. 監看模式（資料庫變動時自動更新報表）")
+    print("17. 背景作業進度／取消")
+
+
+# 背景作業進行中仍可使用的選項：查看報表與預估訂單、明細下鑽、查看進度、退出
+BACKGROUND_SAFE_CHOICES = {'2', '5', '10', '15', '17'}
+
+
+def measure_startup(budget=None):
+    """量測冷啟動：模組匯入、讀取設定、連接資料庫到第一次顯示選單的時間
+    超過 budget（秒）時回傳 1，方便在現場電腦上檢查啟動時間"""
+    timings = [('模組匯入', _IMPORT_FINISHED - _IMPORT_STARTED)]
+    start = time.perf_counter()
+    comparison = FactoryComparison()
+    timings.append(('讀取設定', time.perf_counter() - start))
+    start = time.perf_counter()
+    connected = comparison.connect_to_database(interactive=False)
+    timings.append(('連接資料庫', time.perf_counter() - start))
+    start = time.perf_counter()
+    print_menu()
+    timings.append(('顯示選單', time.perf_counter() - start))
+    comparison.close()
+    
+    total = time.perf_counter() - _IMPORT_STARTED
+    print("\n=== 啟動時間 ===")
+    for name, seconds in timings:
+        print(f"{name.ljust(8)}{seconds * 1000:10.1f} ms")
+    print(f"{'到第一次選單'.ljust(8)}{total * 1000:10.1f} ms")
+    if not connected:
+        print("（資料庫未連線，連接時間僅供參考）")
+    loaded = [name for name in LAZY_MODULES if name in sys.modules]
+    if loaded:
+        print("已提前載入的模組：" + '、'.join(loaded))
+    if budget is not None and total > budget:
+        print(f"啟動時間超過預算 {budget:.2f} 秒")
+        return 1
+    return 0
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.trace:
+        TRACER.enable(args.trace_file)
+    if args.command == 'batch':
+        sys.exit(run_batch(args))
+    if args.command == 'drill':
+        sys.exit(run_drill(args))
+    if args.command == 'watch':
+        sys.exit(run_watch(args))
+    if args.command == 'serve':
+        sys.exit(run_serve(args))
+    if args.command == 'generate':
+        generate_synthetic_data(args.db, args.rows, args.seed, args.estimated, args.estimated_rows,
+                                factories=FactoryRegistry.load())
+        print(f"已產生 {args.rows} 筆合成資料：{args.db}")
+        return
+    if args.command == 'bench':
+        sys.exit(1 if run_benchmark(args.sizes, args.seed, args.work_dir, args.baseline, args.save_baseline,
+                                    args.tolerance, args.stages) else 0)
+    if args.command == 'startup':
+        sys.exit(measure_startup(args.budget))
+    run_menu()
+
+
+def run_menu():
+    job = None
+    
+    def background(name, func, **kwargs):
+        print(f"「{name}」已在背景執行，期間可查看目前的報表（選項2），用選項17查看進度或取消")
+        return BackgroundJob(name, func, **kwargs).start()
+    
     try:
         print("=== 工廠材數比較系統啟動 ===")
         comparison = FactoryComparison()
@@ -714,71 +3592,49 @@ def main():
                 return
         
         while True:
-            print("\n=== 工廠材數比較系統 ===")
-            print("1. 載入資料庫數據（含預估訂單數據）")
-            print("2. 查看比較報告")
-            print("3. 生成比較圖表")
-            print("4. 匯出報表至 Excel")
-            print("5. 查看預估訂單數據")
-            print("6. 設定比例範圍")
-            print("7. 設定每週最大材數")
-            print("8. 更改預估訂單數據路徑")
-            print("9. 更改資料庫位置")
-            print("10. 退出")
+            if job is not None:
+                print(("\n背景作業進行中 — " if job.running else "\n背景作業已結束 — ") + job.describe())
+                if not job.running:
+                    job = None
+            print_menu()
             
-            choice = input("請選擇操作 (1-10): ")
+            choice = input("請選擇操作 (1-17): ")
             
+            if job is not None and job.running and choice not in BACKGROUND_SAFE_CHOICES:
+                print(f"背景作業「{job.name}」進行中，請等待完成或用選項17取消")
+                continue
             if choice == '1':
-                comparison.load_data_from_database()
-                comparison.load_estimated_orders_from_accdb()
+                job = background('載入資料', comparison.load_all)
             elif choice == '2':
-                if not comparison.factory1_data or not comparison.factory2_data:
+                if not comparison.has_factory_data():
                     print("請先載入數據（選項1）")
                     continue
-                report = comparison.generate_report()
                 print("\n=== 比較報告 ===")
-                if not report.empty:
-                    # 日期區間只顯示mm/dd-mm/dd
-                    def short_date_range(date_range):
-                        try:
-                            start, end = date_range.split('-')
-                            start = start.strip()
-                            end = end.strip()
-                            start_md = '/'.join(start.split('/')[1:])
-                            end_md = '/'.join(end.split('/')[1:])
-                            return f"{start_md}-{end_md}"
-                        except Exception:
-                            return date_range
-                    report = report.copy()
-                    report['日期區間'] = report['日期區間'].apply(short_date_range)
-                    # 欄寬根據最大內容自動決定，所有欄名與資料都靠左，欄與欄之間4個空格
-                    col_widths = [max(len(str(x)) for x in report[col].astype(str)) for col in report.columns]
-                    col_widths = [max(w, len(col)) for w, col in zip(col_widths, report.columns)]
-                    # 印欄位名稱（靠左）
-                    header = (' ' * 4).join([str(col).ljust(width) for col, width in zip(report.columns, col_widths)])
-                    print(header)
-                    # 印每一列（靠左）
-                    for _, row in report.iterrows():
-                        line = (' ' * 4).join([str(row[col]).ljust(width) for col, width in zip(report.columns, col_widths)])
-                        print(line)
-                else:
-                    print(report)
+                if job is not None and job.running:
+                    print("（背景作業進行中，以下為目前已載入的數據）")
+                print_report_table(comparison.generate_report())
             elif choice == '3':
-                if not comparison.factory1_data or not comparison.factory2_data:
+                if not comparison.has_factory_data():
                     print("請先載入數據（選項1）")
                     continue
-                comparison.plot_comparison()
+                draft = input("是否使用草稿模式（較快、解析度較低）？(y/n): ").strip().lower() == 'y'
+                job = background('繪製圖表', comparison.plot_comparison, draft=draft)
             elif choice == '4':
-                comparison.export_to_excel()
+                details = input("是否加入每週出貨明細與預估訂單工作表？(y/n): ").strip().lower() == 'y'
+                job = background('匯出Excel', comparison.export_to_excel, details=details)
             elif choice == '5':
-                if comparison.estimated_orders:
+                if not comparison.estimated_orders.empty:
                     print("\n=== 預估訂單數據 ===")
-                    df = pd.DataFrame(comparison.estimated_orders)
-                    # 日期轉型並排序
-                    df['日期'] = pd.to_datetime(df['日期'])
-                    df = df.sort_values(by=['工廠', '日期'], ascending=[True, True])
-                    for _, order in df.iterrows():
-                        print(f"日期: {order['日期'].strftime('%Y-%m-%d')}, 工廠: {order['工廠']}, 門市代號: {order.get('門市代號','')}, 門市: {order['門市']}, 預估材數: {order['預估材數']}, 備註: {order['備註']}")
+                    df = comparison.estimated_orders
+                    df = df.sort_values(by=['工廠', '日期'], ascending=[True, True],
+                                        key=lambda col: col.astype(str) if col.name == '工廠' else col)
+                    lines = ('日期: ' + df['日期'].dt.strftime('%Y-%m-%d').fillna('')
+                             + ', 工廠: ' + df['工廠'].astype(str)
+                             + ', 門市代號: ' + df['門市代號'].astype(str)
+                             + ', 門市: ' + df['門市'].astype(str)
+                             + ', 預估材數: ' + df['預估材數'].astype(str)
+                             + ', 備註: ' + df['備註'].fillna('').astype(str))
+                    print('\n'.join(lines))
                 else:
                     print("尚未載入預估訂單數據，請先執行選項1")
             elif choice == '6':
@@ -799,10 +3655,64 @@ def main():
                 else:
                     print("取消更改資料庫位置。")
             elif choice == '10':
-                if comparison.conn:
-                    comparison.conn.close()
+                if job is not None and job.running:
+                    print("正在取消背景作業...")
+                    job.cancel()
+                    job.wait()
+                comparison.close()
                 print("感謝使用！")
                 break
+            elif choice == '11':
+                job = background('強制重新載入', comparison.force_refresh)
+            elif choice == '12':
+                target_dir = input("請輸入鏡像存放資料夾（直接按 Enter 使用 mirror）: ").strip() or 'mirror'
+                try:
+                    db_mirror, estimated_mirror = comparison.mirror_databases(target_dir)
+                    print(f"已建立鏡像：{db_mirror}、{estimated_mirror}")
+                    print("可用選項 9、8 把資料庫位置改成鏡像檔以加快讀取")
+                except Exception as e:
+                    print(f"建立鏡像時發生錯誤：{str(e)}")
+            elif choice == '13':
+                if not comparison.has_factory_data():
+                    print("請先載入數據（選項1）")
+                    continue
+                comparison.scenario_analysis()
+            elif choice == '14':
+                if not comparison.has_factory_data():
+                    print("請先載入數據（選項1）")
+                    continue
+                uncapped = comparison.factories.uncapped_labels()
+                if uncapped:
+                    print(f"{'、'.join(uncapped)}未設定每週最大材數，只調整工廠、不提前生產（可用選項7設定）")
+                    advance = 0
+                else:
+                    try:
+                        advance = int(input("產能不足時可提前幾週生產（直接按 Enter 為 0，不調整週別）: ").strip() or 0)
+                    except ValueError:
+                        print("請輸入有效的數字")
+                        continue
+                comparison.export_allocation(max_advance_weeks=advance)
+            elif choice == '15':
+                if comparison.main_data_df is None:
+                    print("請先載入數據（選項1）")
+                    continue
+                comparison.drill_down_analysis()
+            elif choice == '16':
+                if not comparison.has_factory_data():
+                    print("請先載入數據（選項1）")
+                    continue
+                watcher = comparison.watch()
+                input("監看中，資料庫變動時會自動更新並列出有變動的週，按 Enter 結束監看...\n")
+                watcher.stop()
+                print(f"已結束監看，共自動更新 {watcher.updates} 次")
+            elif choice == '17':
+                if job is None:
+                    print("目前沒有背景作業")
+                    continue
+                print(job.describe())
+                if job.running and input("是否取消？(y/n): ").strip().lower() == 'y':
+                    job.cancel()
+                    print("已要求取消，作業會在下一個檢查點停止，原本的數據不受影響")
             else:
                 print("無效的選擇，請重試。")
     
@@ -0,0 +1,55 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'F2-0313.py')
+
+
+@pytest.fixture
+def f2(tmp_path, monkeypatch):
+    # 在暫存資料夾執行，設定檔、快照與追蹤檔都不會寫到專案目錄
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location('f2_0313', MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_traced_load_all(f2, tmp_path):
+    db_path = str(tmp_path / 'ev1020.db')
+    estimated_path = str(tmp_path / 'estimated.db')
+    f2.generate_synthetic_data(db_path, 2000, estimated_path=estimated_path, estimated_rows=100)
+    trace_path = str(tmp_path / 'trace.jsonl')
+    f2.TRACER.enable(trace_path)
+    comparison = f2.FactoryComparison()
+    comparison.db_path = db_path
+    comparison.excel_path = estimated_path
+    try:
+        assert comparison.connect_to_database(interactive=False)
+        results = comparison.load_all(use_cache=False)
+    finally:
+        comparison.close()
+        f2.TRACER.finish()
+
+    assert all(result['ok'] for result in results.values())
+    assert len(comparison.estimated_orders) == 100
+    with open(trace_path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    applied = [record for record in records if record['stage'] == '整理預估訂單']
+    assert applied and applied[0]['ok'] and applied[0]['rows_in'] == 100
+
+
+def test_failing_row_counter_does_not_break_stage(f2, tmp_path):
+    @f2.traced('測試階段', rows_in=lambda value: len(value), rows_out=lambda result: result['missing'])
+    def stage(value):
+        return {'value': value}
+
+    f2.TRACER.enable(str(tmp_path / 'trace.jsonl'))
+    try:
+        assert stage(3) == {'value': 3}
+    finally:
+        f2.TRACER.finish()
+    record = f2.TRACER.records[-1]
+    assert record['ok'] and record['rows_in'] is None and record['rows_out'] is None